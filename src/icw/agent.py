@@ -0,0 +1,42 @@
+"""ICW Agent - optional in-process IC client for read-only ledger queries.
+
+Querying ledgers over HTTPS directly avoids forking a `dfx` process per call.
+Needs ic-py (pip install internet-computer-wallet[agent]); callers fall back to
+dfx when it is missing or when talking to a local replica.
+"""
+
+try:
+    from ic.agent import Agent
+    from ic.candid import Types, encode
+    from ic.client import Client
+    from ic.identity import Identity
+except ImportError:
+    Agent = None
+
+IC_URL = "https://icp-api.io"
+
+_agent = None
+
+
+def available(network):
+    """Whether queries on `network` can go through the agent instead of dfx."""
+    return Agent is not None and network == "ic"
+
+
+def get_agent():
+    """Get the shared agent. Queries need no real identity, so a throwaway key signs them."""
+    global _agent
+    if _agent is None:
+        _agent = Agent(Identity(), Client(url=IC_URL))
+    return _agent
+
+
+async def icrc1_balance_of(ledger, owner, subaccount=None):
+    """Query an ICRC-1 ledger for the balance of `owner`'s account (`subaccount`: 32 raw bytes, None for default)."""
+    account = Types.Record({"owner": Types.Principal, "subaccount": Types.Opt(Types.Vec(Types.Nat8))})
+    sa = [] if subaccount is None else [subaccount]
+    arg = encode([{"type": account, "value": {"owner": owner, "subaccount": sa}}])
+    result = await get_agent().query_raw_async(ledger, "icrc1_balance_of", arg)
+    if not isinstance(result, list):
+        raise RuntimeError(f"Query rejected: {result}")
+    return int(result[0]["value"])
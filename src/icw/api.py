@@ -1,31 +1,80 @@
 #!/usr/bin/env python3
 """ICW Web API - FastAPI server for the wallet UI."""
 
+import asyncio
+import functools
+import hashlib
+import json
+import os
 import subprocess
+import time
 import webbrowser
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Optional
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
+import orjson
 import uvicorn
 
+from icw import agent
 from icw.cli import (
+    ACCOUNT_TRANSACTIONS_ARG,
+    BALANCE_ARG,
+    TOKEN_SCALE,
     TOKENS,
-    dfx,
+    TRANSFER_ARG,
+    _principals,
+    cached_usd_price,
+    close_coingecko,
+    dfx_async,
     ensure_dfx,
     get_all_prices,
-    get_usd_price,
     memo,
-    principal,
+    parse_amount,
+    run_dfx_async,
     subaccount,
+    subaccount_bytes,
 )
 
-app = FastAPI(title="ICW Wallet")
+
+class ORJSONResponse(JSONResponse):
+    """JSON response serialized with orjson (much faster than json.dumps on balance/transaction payloads)."""
+
+    def render(self, content):
+        try:
+            return orjson.dumps(content)
+        except orjson.JSONEncodeError:
+            # orjson rejects ints beyond 64 bits, e.g. raw balances of 18-decimal tokens over ~18.4 units
+            return super().render(content)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    loop = asyncio.get_running_loop()
+    if _server_config["network"] == "ic":
+        # Open the keep-alive CoinGecko connection and fill the price cache shared by /api/prices
+        # and the balance endpoints in the background, so the first page load doesn't pay for it
+        loop.run_in_executor(None, get_all_prices)
+    yield
+    close_coingecko()
+
+
+app = FastAPI(title="ICW Wallet", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 STATIC_DIR = Path(__file__).parent / "static"
 
+# Logo/favicon URLs aren't versioned, so no `immutable`: after an upgrade browsers refetch them within a day
+STATIC_CACHE = {"Cache-Control": "public, max-age=86400"}
+
+
+@functools.lru_cache(maxsize=None)
+def load_static(name):
+    """Read a packaged static file once and keep its bytes in memory."""
+    return (STATIC_DIR / name).read_bytes()
+
 
 class TransferRequest(BaseModel):
     token: str = "ckbtc"
@@ -43,30 +92,76 @@ class IdentityRequest(BaseModel):
     name: str
 
 
+async def dfx_text(*args):
+    """Run a plain dfx command (no --network/--output flags) for the server, return its stripped stdout."""
+    return (await run_dfx_async(list(args))).decode().strip()
+
+
+async def active_identity():
+    """Name and principal of dfx's active identity.
+
+    The name is asked for on every call, so switching identity in a terminal shows up in the UI;
+    principals are kept per name in the CLI's cache, so only the first lookup forks get-principal.
+    """
+    name = await dfx_text("identity", "whoami")
+    if name not in _principals:
+        _principals[name] = await dfx_text("identity", "get-principal")
+    return name, _principals[name]
+
+
+# The one cap on concurrent dfx processes: a balance fan-out would otherwise fork one per token
+# at once, which constrained hosts feel. The IC agent path, when installed, forks nothing.
+DFX_WORKERS = int(os.getenv("ICW_DFX_WORKERS", "4"))
+
+
+async def gather_limited(coros, limit=DFX_WORKERS):
+    """Await coroutines concurrently (in order), with at most `limit` in flight to cap dfx processes."""
+    sem = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with sem:
+            return await coro
+
+    return await asyncio.gather(*(run(c) for c in coros))
+
+
 @app.get("/")
 async def index():
-    return FileResponse(STATIC_DIR / "index.html")
+    return Response(load_static("index.html"), media_type="text/html")
 
 
 @app.get("/logo.png")
 async def logo():
-    return FileResponse(STATIC_DIR / "logo.png", media_type="image/png")
+    return Response(load_static("logo.png"), media_type="image/png", headers=STATIC_CACHE)
 
 
 @app.get("/favicon.ico")
 async def favicon():
-    return FileResponse(STATIC_DIR / "logo.png", media_type="image/png")
+    return Response(load_static("logo.png"), media_type="image/png", headers=STATIC_CACHE)
+
+
+def etag_response(request, payload, versioned=None):
+    """Return payload tagged with an ETag, or an empty 304 if the client already holds that version.
+
+    versioned: the part of the payload that identifies its version (defaults to the whole payload).
+    """
+    digest = hashlib.blake2b(orjson.dumps(payload if versioned is None else versioned, option=orjson.OPT_SORT_KEYS))
+    etag = f'"{digest.hexdigest()[:16]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}  # always revalidate; a match costs a 304
+    if etag in (t.strip() for t in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(payload, headers=headers)
 
 
 @app.get("/api/prices")
-async def get_prices():
+async def get_prices(request: Request):
     """Get all token prices in USD."""
-    prices = get_all_prices()
+    prices = await asyncio.to_thread(get_all_prices)
     # Map coingecko IDs back to token names
     result = {}
     for token, (_, name, _, _, cg_id) in TOKENS.items():
         result[token] = {"name": name, "price": prices.get(cg_id), "coingecko_id": cg_id}
-    return {"prices": result, "timestamp": __import__("time").time()}
+    return etag_response(request, {"prices": result, "timestamp": time.time()}, versioned=result)
 
 
 @app.get("/api/identity")
@@ -74,10 +169,7 @@ async def get_identity():
     """Get current identity and principal."""
     ensure_dfx()
     try:
-        identity = subprocess.run(
-            ["dfx", "identity", "whoami"], capture_output=True, text=True, check=True
-        ).stdout.strip()
-        p = principal()
+        identity, p = await active_identity()
         return {"identity": identity, "principal": p}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -88,14 +180,10 @@ async def list_identities():
     """List all identities."""
     ensure_dfx()
     try:
-        current = subprocess.run(
-            ["dfx", "identity", "whoami"], capture_output=True, text=True, check=True
-        ).stdout.strip()
-        r = subprocess.run(["dfx", "identity", "list"], capture_output=True, text=True, check=True)
+        current = await dfx_text("identity", "whoami")
+        listing = await dfx_text("identity", "list")
         ids = [
-            {"name": line.strip(), "active": line.strip() == current}
-            for line in r.stdout.strip().split("\n")
-            if line.strip()
+            {"name": line.strip(), "active": line.strip() == current} for line in listing.split("\n") if line.strip()
         ]
         return {"identities": ids, "current": current}
     except Exception as e:
@@ -107,81 +195,94 @@ async def use_identity(req: IdentityRequest):
     """Switch to a different identity."""
     ensure_dfx()
     try:
-        subprocess.run(["dfx", "identity", "use", req.name], check=True)
-        return {"switched": req.name, "principal": principal()}
+        await dfx_text("identity", "use", req.name)
+        _principals.pop(req.name, None)  # look the principal up afresh, as switch_identity does
+        _, p = await active_identity()
+        return {"switched": req.name, "principal": p}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def balance_of(ledger_id, owner, network, sa="0"):
+    """Query an ICRC-1 balance, in-process via the IC agent when possible, otherwise through dfx."""
+    if agent.available(network):
+        return await agent.icrc1_balance_of(ledger_id, owner, subaccount_bytes(sa))
+    sa_arg = subaccount(sa)
+
+    return int(
+        await dfx_async(["canister", "call", ledger_id, "icrc1_balance_of", BALANCE_ARG % (owner, sa_arg)], network)
+        or 0
+    )
+
+
+async def account_balance(token, owner, network, subaccount="0", ledger=""):
+    """Balance of `owner`'s account in `token`, with its USD value."""
+    default_ledger, name, _, _, cg_id = TOKENS[token]
+    ledger_id = ledger if ledger else default_ledger
+    bal = await balance_of(ledger_id, owner, network, subaccount)
+    human = bal / TOKEN_SCALE[token]
+    price = await asyncio.to_thread(cached_usd_price, cg_id) if network == "ic" else None
+    usd = round(human * price, 2) if price else None
+    return {
+        "token": name,
+        "balance": human,
+        "raw": bal,
+        "usd": usd,
+        "price": price,
+        "principal": owner,
+        "ledger": ledger_id,
+    }
+
+
 @app.get("/api/balance/{token}")
 async def get_balance(token: str, network: str = "ic", subaccount: str = "0", ledger: str = ""):
     """Get token balance with USD value."""
     if token not in TOKENS:
         raise HTTPException(status_code=400, detail=f"Unknown token: {token}")
 
-    default_ledger, name, dec, _, cg_id = TOKENS[token]
-    ledger_id = ledger if ledger else default_ledger
     try:
-        p = principal()
-        from icw.cli import subaccount as sa_fn
-
-        bal = int(
-            dfx(
-                [
-                    "canister",
-                    "call",
-                    ledger_id,
-                    "icrc1_balance_of",
-                    f'(record {{ owner = principal "{p}"; subaccount = {sa_fn(subaccount)}; }})',
-                ],
-                network,
-            )
-            or 0
-        )
-        human = bal / 10**dec
-        price = get_usd_price(cg_id) if network == "ic" else None
-        usd = round(human * price, 2) if price else None
-        return {
-            "token": name,
-            "balance": human,
-            "raw": bal,
-            "usd": usd,
-            "price": price,
-            "principal": p,
-            "ledger": ledger_id,
-        }
+        _, p = await active_identity()
+        return await account_balance(token, p, network, subaccount, ledger)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/api/balances")
+@app.get("/api/balances", response_model=None)
 async def get_all_balances(network: str = "ic", ledgers: str = ""):
     """Get all token balances.
 
     ledgers: JSON-encoded dict of token -> ledger_id mappings (for local testing)
     """
-    import json as json_lib
-
     ledger_map = {}
     if ledgers:
         try:
-            ledger_map = json_lib.loads(ledgers)
+            ledger_map = json.loads(ledgers)
         except Exception:
             # Ignore malformed JSON; use empty ledger map
             pass
 
-    balances = []
+    try:
+        _, p = await active_identity()  # once for the page, not once per token
+    except Exception:
+        p = None
+
+    async def one(token, custom_ledger):
+        if p is not None:
+            try:
+                return await account_balance(token, p, network, "0", custom_ledger)
+            except Exception:
+                pass
+        return {"token": TOKENS[token][1], "balance": 0, "error": True}
+
+    tasks = []
     for token in TOKENS:
-        try:
-            custom_ledger = ledger_map.get(token, "")
-            # Skip tokens without custom ledgers on local network
-            if network == "local" and not custom_ledger:
-                continue
-            bal = await get_balance(token, network, "0", custom_ledger)
-            balances.append(bal)
-        except Exception:
-            balances.append({"token": TOKENS[token][1], "balance": 0, "error": True})
-    return {"balances": balances}
+        custom_ledger = ledger_map.get(token, "")
+        # Skip tokens without custom ledgers on local network
+        if network == "local" and not custom_ledger:
+            continue
+        tasks.append(one(token, custom_ledger))
+    balances = await gather_limited(tasks)
+    return ORJSONResponse({"balances": balances})
 
 
 @app.post("/api/transfer")
@@ -191,19 +292,21 @@ async def transfer(req: TransferRequest):
         raise HTTPException(status_code=400, detail=f"Unknown token: {req.token}")
 
     default_ledger, name, dec, default_fee, _ = TOKENS[req.token]
+    div = TOKEN_SCALE[req.token]
     ledger_id = req.ledger if req.ledger else default_ledger
     fee = req.fee if req.fee is not None else default_fee
     try:
-        amt = int(float(req.amount) * 10**dec) if "." in req.amount else int(req.amount)
+        amt = parse_amount(req.amount, dec)
         memo_val = memo(req.memo) if req.memo else "null"
 
-        r = dfx(
+        r = await dfx_async(
             [
                 "canister",
                 "call",
                 ledger_id,
                 "icrc1_transfer",
-                f'(record {{ to = record {{ owner = principal "{req.recipient}"; subaccount = {subaccount(req.subaccount)}; }}; amount = {amt}; fee = opt {fee}; memo = {memo_val}; created_at_time = null; from_subaccount = {subaccount(req.from_subaccount)}; }})',
+                TRANSFER_ARG
+                % (req.recipient, subaccount(req.subaccount), amt, fee, memo_val, subaccount(req.from_subaccount)),
             ],
             req.network,
         )
@@ -213,7 +316,7 @@ async def transfer(req: TransferRequest):
                 "ok": True,
                 "block": r["Ok"],
                 "token": name,
-                "amount": amt / 10**dec,
+                "amount": amt / div,
                 "to": req.recipient,
             }
             if req.memo:
@@ -230,60 +333,64 @@ async def transfer(req: TransferRequest):
 @app.get("/explorer")
 async def explorer():
     """Serve the explorer page."""
-    return FileResponse(STATIC_DIR / "explorer.html")
+    return Response(load_static("explorer.html"), media_type="text/html")
 
 
-@app.get("/api/account/{account}/balances")
+@app.get("/api/account/{account}/balances", response_model=None)
 async def get_account_balances(account: str, network: str = "ic", ledgers: str = ""):
     """Get all token balances for a specific account (principal)."""
-    import json as json_lib
-
     ledger_map = {}
     if ledgers:
         try:
-            ledger_map = json_lib.loads(ledgers)
+            ledger_map = json.loads(ledgers)
         except Exception:
             pass
 
-    balances = []
-    for token in TOKENS:
+    async def one(token, custom_ledger):
         try:
-            custom_ledger = ledger_map.get(token, "")
-            if network == "local" and not custom_ledger:
-                continue
-            default_ledger, name, dec, _, cg_id = TOKENS[token]
-            ledger_id = custom_ledger if custom_ledger else default_ledger
-            from icw.cli import subaccount as sa_fn
-
-            bal = int(
-                dfx(
-                    [
-                        "canister",
-                        "call",
-                        ledger_id,
-                        "icrc1_balance_of",
-                        f'(record {{ owner = principal "{account}"; subaccount = {sa_fn("0")}; }})',
-                    ],
-                    network,
-                )
-                or 0
-            )
-            human = bal / 10**dec
-            price = get_usd_price(cg_id) if network == "ic" else None
-            usd = round(human * price, 2) if price else None
-            balances.append(
-                {
-                    "token": name,
-                    "balance": human,
-                    "raw": bal,
-                    "usd": usd,
-                    "price": price,
-                    "ledger": ledger_id,
-                }
-            )
+            return await account_balance(token, account, network, "0", custom_ledger)
         except Exception:
-            balances.append({"token": TOKENS[token][1], "balance": 0, "error": True})
-    return {"balances": balances, "account": account}
+            return {"token": TOKENS[token][1], "balance": 0, "error": True}
+
+    tasks = []
+    for token in TOKENS:
+        custom_ledger = ledger_map.get(token, "")
+        if network == "local" and not custom_ledger:
+            continue
+        tasks.append(one(token, custom_ledger))
+    balances = await gather_limited(tasks)
+    return ORJSONResponse({"balances": balances, "account": account})
+
+
+# Candid renders nats with digit separators ("1_000_000")
+_DIGIT_SEPARATORS = str.maketrans("", "", "_")
+
+
+def _nat(v):
+    """Parse a Candid nat that may come back as a separated string or a plain int."""
+    return int(v.translate(_DIGIT_SEPARATORS)) if isinstance(v, str) else int(v)
+
+
+# Which account fields each index-canister transaction kind carries
+_TX_PARTIES = {
+    "transfer": ("from", "to"),
+    "mint": ("to",),
+    "burn": ("from",),
+}
+
+
+def _parse_tx_operation(tx, kind):
+    """Return (from owner, to owner, raw amount) for a transaction; unknown kinds give (None, None, 0)."""
+    parties = _TX_PARTIES.get(kind)
+    op = tx.get(kind) if parties else None
+    # Candid opt records come back as a one-element list
+    if isinstance(op, list):
+        op = op[0] if op else None
+    if not isinstance(op, dict):
+        return None, None, 0
+    from_account = op["from"].get("owner", "") if "from" in parties and "from" in op else None
+    to_account = op["to"].get("owner", "") if "to" in parties and "to" in op else None
+    return from_account, to_account, _nat(op.get("amount", "0"))
 
 
 INDEX_CANISTERS = {
@@ -296,7 +403,7 @@ INDEX_CANISTERS = {
 }
 
 
-@app.get("/api/transactions/{token}")
+@app.get("/api/transactions/{token}", response_model=None)
 async def get_transactions(
     token: str,
     account: str = "",
@@ -309,7 +416,8 @@ async def get_transactions(
     if token not in TOKENS:
         raise HTTPException(status_code=400, detail=f"Unknown token: {token}")
 
-    _, name, dec, _, _ = TOKENS[token]
+    _, name, _, _, _ = TOKENS[token]
+    div = TOKEN_SCALE[token]
     index_id = index if index else INDEX_CANISTERS.get(token, "")
 
     if not index_id:
@@ -317,24 +425,24 @@ async def get_transactions(
             return {
                 "transactions": [],
                 "token": name,
-                "account": account if account else principal(),
+                "account": account if account else (await active_identity())[1],
                 "total": 0,
                 "error": "No index canister configured for local network. Add it in the Local Network Configuration panel.",
             }
         raise HTTPException(status_code=400, detail=f"No index canister for {token}")
 
     # Get the account to query (default to current identity)
-    query_account = account if account else principal()
+    query_account = account if account else (await active_identity())[1]
 
     try:
         # Query the index canister for account transactions
-        result = dfx(
+        result = await dfx_async(
             [
                 "canister",
                 "call",
                 index_id,
                 "get_account_transactions",
-                f'(record {{ account = record {{ owner = principal "{query_account}"; subaccount = null }}; start = null; max_results = {limit} : nat }})',
+                ACCOUNT_TRANSACTIONS_ARG % (query_account, limit),
             ],
             network,
         )
@@ -347,85 +455,36 @@ async def get_transactions(
 
                 for tx_entry in data.get("transactions", []):
                     try:
-                        tx_id = tx_entry.get("id", 0)
-                        if isinstance(tx_id, str):
-                            tx_id = int(tx_id.replace("_", ""))
-
-                        tx = tx_entry.get("transaction", {})
+                        tx = tx_entry.get("transaction") or {}
                         kind = tx.get("kind", "unknown")
                         timestamp = tx.get("timestamp")
-                        if isinstance(timestamp, str):
-                            timestamp = int(timestamp.replace("_", ""))
-
-                        from_account = None
-                        to_account = None
-                        amount = 0
-
-                        # Parse based on transaction kind
-                        if kind == "transfer" and tx.get("transfer"):
-                            transfer = tx["transfer"]
-                            if isinstance(transfer, list) and len(transfer) > 0:
-                                transfer = transfer[0]
-
-                            if "from" in transfer:
-                                from_acc = transfer["from"]
-                                from_account = from_acc.get("owner", "")
-                            if "to" in transfer:
-                                to_acc = transfer["to"]
-                                to_account = to_acc.get("owner", "")
-
-                            amt = transfer.get("amount", "0")
-                            amount = int(str(amt).replace("_", ""))
-
-                        elif kind == "mint" and tx.get("mint"):
-                            mint = tx["mint"]
-                            if isinstance(mint, list) and len(mint) > 0:
-                                mint = mint[0]
-
-                            if "to" in mint:
-                                to_acc = mint["to"]
-                                to_account = to_acc.get("owner", "")
-
-                            amt = mint.get("amount", "0")
-                            amount = int(str(amt).replace("_", ""))
-
-                        elif kind == "burn" and tx.get("burn"):
-                            burn = tx["burn"]
-                            if isinstance(burn, list) and len(burn) > 0:
-                                burn = burn[0]
-
-                            if "from" in burn:
-                                from_acc = burn["from"]
-                                from_account = from_acc.get("owner", "")
-
-                            amt = burn.get("amount", "0")
-                            amount = int(str(amt).replace("_", ""))
-
+                        from_account, to_account, amount = _parse_tx_operation(tx, kind)
                         transactions.append(
                             {
-                                "block": tx_id,
+                                "block": _nat(tx_entry["id"]),
                                 "type": kind,
                                 "from": from_account,
                                 "to": to_account,
-                                "amount": amount / 10**dec,
+                                "amount": amount / div,
                                 "amount_raw": amount,
-                                "timestamp": timestamp,
+                                "timestamp": _nat(timestamp) if timestamp is not None else None,
                             }
                         )
-
                     except Exception:
-                        continue
+                        continue  # one entry we can't parse shouldn't cost the user the whole history
 
             elif "Err" in result:
                 raise HTTPException(status_code=400, detail=str(result["Err"]))
 
-        return {
-            "transactions": transactions,
-            "token": name,
-            "account": query_account,
-            "total": len(transactions),
-            "index": index_id,
-        }
+        return ORJSONResponse(
+            {
+                "transactions": transactions,
+                "token": name,
+                "account": query_account,
+                "total": len(transactions),
+                "index": index_id,
+            }
+        )
 
     except HTTPException:
         raise
@@ -440,9 +499,9 @@ async def get_info(token: str, network: str = "ic"):
         raise HTTPException(status_code=400, detail=f"Unknown token: {token}")
 
     ledger, name, dec, fee, cg_id = TOKENS[token]
-    price = get_usd_price(cg_id)
+    price = await asyncio.to_thread(cached_usd_price, cg_id) if network == "ic" else None
     try:
-        user_principal = principal()
+        user_principal = (await active_identity())[1]
     except Exception:
         user_principal = None
     return {
@@ -450,7 +509,7 @@ async def get_info(token: str, network: str = "ic"):
         "ledger": ledger,
         "decimals": dec,
         "fee": fee,
-        "fee_human": fee / 10**dec,
+        "fee_human": fee / TOKEN_SCALE[token],
         "price_usd": price,
         "principal": user_principal,
         "network": network,
@@ -461,9 +520,9 @@ async def get_info(token: str, network: str = "ic"):
 _server_config = {"network": "ic", "ledgers": {}}
 
 
+@functools.lru_cache(maxsize=1)
 def get_version_info():
-    """Get version, git commit, and build date."""
-    import subprocess
+    """Get version, git commit, and build date (computed once per process)."""
     from icw import __version__
 
     try:
@@ -490,9 +549,9 @@ def get_version_info():
 
 
 @app.get("/api/config")
-async def get_config():
+async def get_config(request: Request):
     """Get server configuration (network, ledgers, version)."""
-    return {**_server_config, **get_version_info()}
+    return etag_response(request, {**_server_config, **get_version_info()})
 
 
 def run_server(
@@ -504,6 +563,7 @@ def run_server(
     """Start the web UI server."""
     global _server_config
     _server_config = {"network": network, "ledgers": ledgers or {}}
+    get_version_info()  # resolve git metadata before serving, not on the first /api/config
 
     if open_browser:
         webbrowser.open(f"http://localhost:{port}")
@@ -2,14 +2,20 @@
 """ICW - ICP Wallet CLI for ICRC-1 tokens (ckBTC, ckETH, ICP)."""
 
 import argparse
+import functools
 
 from icw import __version__
 import json
-import platform
-import shutil
 import subprocess
 import sys
-import urllib.request
+import os
+import threading
+import time
+
+try:
+    import orjson  # optional: faster JSON (pip install internet-computer-wallet[fast])
+except ImportError:
+    orjson = None
 
 TOKENS = {
     "ckbtc": ("mxzaz-hqaaa-aaaar-qaada-cai", "ckBTC", 8, 10, "bitcoin"),
@@ -20,130 +26,298 @@ TOKENS = {
     "realms": ("xbkkh-syaaa-aaaah-qq3ya-cai", "REALMS", 8, 10000, None),  # Custom token, no CoinGecko
 }
 
+# 10**decimals per token, so amounts are scaled without a big-int pow per value
+TOKEN_SCALE = {token: 10 ** meta[2] for token, meta in TOKENS.items()}
+
+
+COINGECKO_HOST = "api.coingecko.com"
+COINGECKO_MAX_BODY = 65536  # price replies are a few hundred bytes; anything bigger is an error page
+
+# One keep-alive HTTPS connection shared by all price lookups (saves a TLS handshake per call)
+_coingecko = {"conn": None}
+_coingecko_lock = threading.Lock()
+
+
+def coingecko_get(path):
+    """GET a CoinGecko API path over the shared connection, return parsed JSON."""
+    import http.client
+
+    with _coingecko_lock:
+        while True:
+            fresh = _coingecko["conn"] is None
+            if fresh:
+                _coingecko["conn"] = http.client.HTTPSConnection(COINGECKO_HOST, timeout=10)
+            conn = _coingecko["conn"]
+            try:
+                conn.request("GET", path, headers={"User-Agent": "ICW/1.0", "Accept": "application/json"})
+                r = conn.getresponse()
+                body = r.read(COINGECKO_MAX_BODY + 1)
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                _coingecko["conn"] = None
+                if fresh:
+                    raise
+                continue  # server dropped the idle connection, retry once on a new one
+            if len(body) > COINGECKO_MAX_BODY:
+                # Rest of the body is still unread, so this connection can't be reused
+                conn.close()
+                _coingecko["conn"] = None
+                raise RuntimeError("CoinGecko response too large")
+            if r.will_close:
+                # Server opted out of keep-alive; start fresh next time instead of failing on a dead socket
+                conn.close()
+                _coingecko["conn"] = None
+            if r.status != 200:
+                raise RuntimeError(f"CoinGecko returned HTTP {r.status}")
+            return json_loads(body)
+
+
+def close_coingecko():
+    """Close the shared CoinGecko connection, if open."""
+    with _coingecko_lock:
+        if _coingecko["conn"] is not None:
+            _coingecko["conn"].close()
+            _coingecko["conn"] = None
+
+
+# CoinGecko ids of all listed tokens; one /simple/price request covers them all for the cost of one
+COINGECKO_IDS = tuple(t[4] for t in TOKENS.values() if t[4])
+
+
+def fetch_usd_prices(ids):
+    """Fetch USD prices for several CoinGecko ids in one request (raises on failure)."""
+    data = coingecko_get(f"/api/v3/simple/price?ids={','.join(ids)}&vs_currencies=usd")
+    return {cg_id: data.get(cg_id, {}).get("usd") for cg_id in ids}
+
+
+def _with_listed(coingecko_id):
+    """All listed ids, plus `coingecko_id` if it isn't one of them."""
+    return COINGECKO_IDS if coingecko_id in COINGECKO_IDS else COINGECKO_IDS + (coingecko_id,)
+
 
 def get_usd_price(coingecko_id):
-    """Fetch USD price from CoinGecko (free, no API key)."""
-    try:
-        url = f"https://api.coingecko.com/api/v3/simple/price?ids={coingecko_id}&vs_currencies=usd"
-        req = urllib.request.Request(url, headers={"User-Agent": "ICW/1.0"})
-        with urllib.request.urlopen(req, timeout=10) as r:
-            return json.loads(r.read()).get(coingecko_id, {}).get("usd")
-    except Exception:
+    """USD price for the CLI: served from the on-disk cache while fresh, fetched from CoinGecko otherwise.
+
+    A miss refreshes every listed token at once, so the next command for another token hits the cache.
+    """
+    from icw import pricecache
+
+    if not coingecko_id:
         return None
+    price = pricecache.get(coingecko_id)
+    if price is None:
+        try:
+            prices = fetch_usd_prices(_with_listed(coingecko_id))
+        except Exception:
+            return None
+        pricecache.put(prices)
+        price = prices[coingecko_id]
+    return price
 
 
-_price_cache = {"data": {}, "timestamp": 0}
+_usd_price_cache = {}  # coingecko_id -> (monotonic timestamp, price)
+_usd_price_lock = threading.Lock()
+
+
+def cached_usd_price(coingecko_id, ttl=30):
+    """USD price for the UI server, reusing results for `ttl` seconds per coin.
+
+    A miss fetches all listed tokens in one request, so a page of balances costs a single lookup.
+    """
+    if not coingecko_id:
+        return None
+    hit = _usd_price_cache.get(coingecko_id)
+    if hit and time.monotonic() - hit[0] < ttl:
+        return hit[1]
+    with _usd_price_lock:
+        # Concurrent balance requests miss together; only the first one goes to CoinGecko
+        now = time.monotonic()
+        hit = _usd_price_cache.get(coingecko_id)
+        if hit and now - hit[0] < ttl:
+            return hit[1]
+        ids = _with_listed(coingecko_id)
+        try:
+            prices = fetch_usd_prices(ids)
+        except Exception:
+            # Don't retry per coin until the TTL passes, but keep any prices that are still fresh
+            fresh = {cg_id for cg_id, (ts, _) in _usd_price_cache.items() if now - ts < ttl}
+            prices = {cg_id: None for cg_id in ids if cg_id not in fresh}
+        for cg_id, price in prices.items():
+            _usd_price_cache[cg_id] = (now, price)
+        return prices[coingecko_id]
 
 
 def get_all_prices():
-    """Fetch all token prices in a single API call (cached for 30 seconds)."""
-    import time
+    """USD prices for every listed token, from the same 30-second cache as cached_usd_price (one request per miss)."""
+    return {cg_id: cached_usd_price(cg_id) for cg_id in COINGECKO_IDS}
 
-    now = time.time()
-    # Return cached data if less than 30 seconds old
-    if _price_cache["data"] and (now - _price_cache["timestamp"]) < 30:
-        return _price_cache["data"]
 
-    try:
-        ids = ",".join(t[4] for t in TOKENS.values())  # coingecko IDs
-        url = f"https://api.coingecko.com/api/v3/simple/price?ids={ids}&vs_currencies=usd"
-        req = urllib.request.Request(url, headers={"User-Agent": "ICW/1.0"})
-        with urllib.request.urlopen(req, timeout=10) as r:
-            data = json.loads(r.read())
-            result = {cg_id: data.get(cg_id, {}).get("usd") for cg_id in data}
-            _price_cache["data"] = result
-            _price_cache["timestamp"] = now
-            return result
-    except Exception:
-        # Return stale cache if available
-        return _price_cache["data"] or {}
+def json_loads(data):
+    """Parse JSON from str or bytes, using orjson when installed."""
+    return orjson.loads(data) if orjson else json.loads(data)
 
 
-def output(data):
-    """Print JSON output (human-readable + machine-parseable)."""
-    print(json.dumps(data, indent=2))
+def json_dumps_pretty_bytes(data):
+    """Serialize to 2-space indented UTF-8 JSON, using orjson when installed."""
+    if orjson:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+        except orjson.JSONEncodeError:
+            pass  # ints beyond 64 bits, let the stdlib handle them
+    return json.dumps(data, indent=2).encode()
 
 
-def detect_local_canisters():
-    """Auto-detect canister IDs from dfx.json or canister_ids.json in current directory."""
-    from pathlib import Path
+def json_dumps_pretty(data):
+    """Serialize to 2-space indented JSON text."""
+    return json_dumps_pretty_bytes(data).decode()
 
-    canisters = {}
-    cwd = Path.cwd()
-
-    # Map of common canister names to token keys
-    name_map = {
-        "ckbtc_ledger": "ckbtc",
-        "ckbtc-ledger": "ckbtc",
-        "ckbtc": "ckbtc",
-        "cketh_ledger": "cketh",
-        "cketh-ledger": "cketh",
-        "cketh": "cketh",
-        "icp_ledger": "icp",
-        "icp-ledger": "icp",
-        "ledger": "icp",
-        "ckusdc_ledger": "ckusdc",
-        "ckusdc-ledger": "ckusdc",
-        "ckusdc": "ckusdc",
-        "ckusdt_ledger": "ckusdt",
-        "ckusdt-ledger": "ckusdt",
-        "ckusdt": "ckusdt",
-        "realms_ledger": "realms",
-        "realms-ledger": "realms",
-        "realms": "realms",
-        "token_backend": "realms",
-    }
-
-    # Try canister_ids.json first (for local network)
-    for filename in ["canister_ids.json", ".dfx/local/canister_ids.json"]:
-        path = cwd / filename
-        if path.exists():
-            try:
-                data = json.loads(path.read_text())
-                for name, info in data.items():
-                    token = name_map.get(name.lower())
-                    if token:
-                        # Handle both {"canister_id": ...} and {"local": "..."}
-                        if isinstance(info, dict):
-                            cid = info.get("local") or info.get("ic") or info.get("canister_id")
-                            if cid:
-                                canisters[token] = cid
-                        elif isinstance(info, str):
-                            canisters[token] = info
-            except Exception:
-                # Ignore errors reading/parsing canister_ids.json; file may be malformed
-                pass
-
-    # Try dfx.json for canister definitions
-    dfx_path = cwd / "dfx.json"
-    if dfx_path.exists():
+
+def json_dumps_bytes(data):
+    """Serialize to compact UTF-8 JSON, using orjson when installed."""
+    if orjson:
         try:
-            data = json.loads(dfx_path.read_text())
-            for name in data.get("canisters", {}):
-                token = name_map.get(name.lower())
-                if token and token not in canisters:
-                    # dfx.json doesn't have IDs, but we note the canister exists
-                    pass
-        except Exception:
-            # Ignore errors reading/parsing dfx.json; canister detection is best-effort
+            return orjson.dumps(data)
+        except orjson.JSONEncodeError:
             pass
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+_output = {"pretty": None}  # None: decide from ICW_PRETTY / whether stdout is a terminal
+
+
+def pretty_output():
+    """Indent JSON for people (a terminal, --pretty or ICW_PRETTY=1); keep it compact when piped."""
+    if _output["pretty"] is None:
+        env = os.getenv("ICW_PRETTY")
+        _output["pretty"] = env == "1" if env is not None else sys.stdout.isatty()
+    return _output["pretty"]
+
+
+def output(data):
+    """Print JSON output (indented on a terminal, compact for scripts)."""
+    dumps = json_dumps_pretty_bytes if pretty_output() else json_dumps_bytes
+    out = getattr(sys.stdout, "buffer", None)
+    if out is None:  # stdout replaced by a text-only stream
+        sys.stdout.write(dumps(data).decode() + "\n")
+        return
+    # Write the encoded JSON straight to the byte stream, skipping the text layer's re-encode
+    sys.stdout.flush()  # keep ordering with anything already printed
+    out.write(dumps(data) + b"\n")
+    out.flush()
+
+
+# Map of common canister names to token keys
+_CANISTER_NAME_MAP = {
+    "ckbtc_ledger": "ckbtc",
+    "ckbtc-ledger": "ckbtc",
+    "ckbtc": "ckbtc",
+    "cketh_ledger": "cketh",
+    "cketh-ledger": "cketh",
+    "cketh": "cketh",
+    "icp_ledger": "icp",
+    "icp-ledger": "icp",
+    "ledger": "icp",
+    "ckusdc_ledger": "ckusdc",
+    "ckusdc-ledger": "ckusdc",
+    "ckusdc": "ckusdc",
+    "ckusdt_ledger": "ckusdt",
+    "ckusdt-ledger": "ckusdt",
+    "ckusdt": "ckusdt",
+    "realms_ledger": "realms",
+    "realms-ledger": "realms",
+    "realms": "realms",
+    "token_backend": "realms",
+}
+
+
+_canister_files = {}  # path -> (st_mtime_ns, {token: canister_id}); re-parsed only when the file changes
+
+
+def detect_local_canisters():
+    """Auto-detect canister IDs from canister_ids.json (or .dfx/local/canister_ids.json) in current directory."""
+    canisters = {}  # fresh dict so callers can add overrides without touching the cached entries
+    cwd = os.getcwd()
+    # .dfx/local is written by the latest deploy, so its IDs win over the checked-in file
+    for filename in ("canister_ids.json", os.path.join(".dfx", "local", "canister_ids.json")):
+        canisters.update(_read_canister_ids(os.path.join(cwd, filename)))
+    return canisters
 
+
+def _read_canister_ids(path):
+    """Map the known ledgers in one canister_ids.json to their IDs, reusing the last parse until the file changes."""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}  # missing file: one failed stat, nothing to read
+    cached = _canister_files.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    canisters = {}
+    try:
+        with open(path, "rb") as f:
+            data = json_loads(f.read())
+        for name, info in data.items():
+            token = _CANISTER_NAME_MAP.get(name.lower())
+            if token:
+                # Handle both {"canister_id": ...} and {"local": "..."}
+                if isinstance(info, dict):
+                    cid = info.get("local") or info.get("ic") or info.get("canister_id")
+                    if cid:
+                        canisters[token] = cid
+                elif isinstance(info, str):
+                    canisters[token] = info
+    except Exception:
+        # Unreadable or malformed canister_ids.json; skip it
+        pass
+    _canister_files[path] = (mtime, canisters)
     return canisters
 
 
+DFX_INSTALL_URL = "https://internetcomputer.org/install.sh"
+
+_dfx = {"path": None}  # absolute path once dfx has been found on PATH; it won't move mid-run
+
+
+def find_dfx():
+    """Absolute path to dfx, or None if it isn't on PATH (the lookup is cached once it succeeds)."""
+    if _dfx["path"] is None:
+        import shutil
+
+        _dfx["path"] = shutil.which("dfx")
+    return _dfx["path"]
+
+
+def run_dfx(args, **kwargs):
+    """subprocess.run for dfx.
+
+    With an absolute executable and close_fds off, CPython starts the child with posix_spawn
+    rather than fork+exec, which avoids copying our page tables. Leaving fds open is safe:
+    Python creates its descriptors non-inheritable.
+    """
+    return subprocess.run([find_dfx() or "dfx", *args], close_fds=False, **kwargs)
+
+
 def ensure_dfx():
     """Check dfx is installed, offer to install if not."""
-    if shutil.which("dfx"):
+    if find_dfx():
         return
+    import platform
+
     print("dfx not found. Install now? [y/N] ", end="")
     if input().strip().lower() not in ("y", "yes"):
-        sys.exit('Install dfx: sh -ci "$(curl -fsSL https://internetcomputer.org/install.sh)"')
+        sys.exit(f'Install dfx: sh -ci "$(curl -fsSL {DFX_INSTALL_URL})"')
     if platform.system().lower() == "windows":
         sys.exit(
             "Use WSL on Windows. See: https://internetcomputer.org/docs/current/developer-docs/getting-started/install"
         )
-    subprocess.run('sh -ci "$(curl -fsSL https://internetcomputer.org/install.sh)"', shell=True, check=True)
-    if not shutil.which("dfx"):
+    import urllib.request
+
+    # Fetch the installer ourselves and hand it to sh directly (no wrapper shell, no curl process)
+    with urllib.request.urlopen(DFX_INSTALL_URL, timeout=30) as r:
+        script = r.read().decode()
+    subprocess.run(["sh", "-ci", script], check=True)
+    if not find_dfx():
         sys.exit("Install failed. Add ~/.local/share/dfx/bin to PATH")
 
 
@@ -157,37 +331,121 @@ CANDID_HASH_MAP = {
 }
 
 
+_CANDID_HASH_KEYS = frozenset(CANDID_HASH_MAP)
+
+
 def normalize_candid_response(obj):
-    """Recursively replace Candid hash keys with field names."""
-    if isinstance(obj, dict):
-        return {CANDID_HASH_MAP.get(k, k): normalize_candid_response(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [normalize_candid_response(v) for v in obj]
+    """Replace Candid hash keys with field names throughout a parsed dfx response.
+
+    Works in place with an explicit stack: freshly parsed JSON is ours to modify, and most
+    responses contain no hash keys at all, so nothing needs to be copied.
+    """
+    field_name = CANDID_HASH_MAP.get  # bound once, not looked up per key
+    stack = [obj]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if not _CANDID_HASH_KEYS.isdisjoint(node):
+                items = list(node.items())
+                node.clear()
+                node.update((field_name(k, k), v) for k, v in items)  # keeps key order
+            values = node.values()
+        elif isinstance(node, list):
+            values = node
+        else:
+            continue
+        stack.extend(v for v in values if isinstance(v, (dict, list)))
     return obj
 
 
+def parse_dfx_output(out):
+    """Parse `dfx --output json` stdout (raw bytes); non-JSON output comes back as a cleaned-up string."""
+    try:
+        result = json_loads(out)
+        return normalize_candid_response(result)
+    except json.JSONDecodeError:
+        return out.decode(errors="replace").strip().replace("_", "").replace('"', "")
+
+
 def dfx(args, network="ic"):
     """Run dfx command, return parsed JSON."""
     ensure_dfx()
-    r = subprocess.run(["dfx"] + args + ["--network", network, "--output", "json"], capture_output=True, text=True)
+    # Keep stdout as bytes: the JSON parser takes them directly, no decode pass needed
+    r = run_dfx(args + ["--network", network, "--output", "json"], capture_output=True)
     if r.returncode != 0:
-        sys.exit(f"Error: {r.stderr.strip()}")
-    try:
-        result = json.loads(r.stdout)
-        return normalize_candid_response(result)
-    except json.JSONDecodeError:
-        return r.stdout.strip().replace("_", "").replace('"', "")
+        sys.exit(f"Error: {r.stderr.decode(errors='replace').strip()}")
+    return parse_dfx_output(r.stdout)
+
+
+async def run_dfx_async(args):
+    """run_dfx for the UI server: await dfx without blocking the event loop, return its stdout bytes.
+
+    Raises RuntimeError on failure rather than exiting like dfx(), so a failed call can't stop the server.
+    """
+    import asyncio
+
+    proc = await asyncio.create_subprocess_exec(
+        find_dfx() or "dfx",
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        close_fds=False,  # see run_dfx
+    )
+    out, err = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"Error: {err.decode(errors='replace').strip()}")
+    return out
+
+
+async def dfx_async(args, network="ic"):
+    """Run dfx command without blocking the event loop, return parsed JSON (raises RuntimeError on failure)."""
+    ensure_dfx()
+    return parse_dfx_output(await run_dfx_async(args + ["--network", network, "--output", "json"]))
+
+
+_current_identity = {"name": None}  # dfx's active identity, looked up once per process
+_principals = {}  # identity name (None: whichever was active at startup) -> principal
 
 
 def principal():
-    return subprocess.run(
-        ["dfx", "identity", "get-principal"], capture_output=True, text=True, check=True
-    ).stdout.strip()
+    """Principal of the active dfx identity (one `dfx identity get-principal` per identity per process)."""
+    key = _current_identity["name"]
+    if key not in _principals:
+        _principals[key] = run_dfx(
+            ["identity", "get-principal"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    return _principals[key]
 
 
 def get_current_identity():
     """Get the name of the currently active dfx identity."""
-    return subprocess.run(["dfx", "identity", "whoami"], capture_output=True, text=True, check=True).stdout.strip()
+    if _current_identity["name"] is None:
+        _current_identity["name"] = run_dfx(
+            ["identity", "whoami"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    return _current_identity["name"]
+
+
+def switch_identity(name):
+    """Make `name` dfx's active identity and remember it as current (its principal is looked up afresh)."""
+    _current_identity["name"] = None
+    run_dfx(["identity", "use", name], capture_output=True, check=True)
+    _principals.pop(name, None)
+    _current_identity["name"] = name
+
+
+def identity_list():
+    """Get the raw `dfx identity list` output, one identity name per line."""
+    return run_dfx(["identity", "list"], capture_output=True, text=True, check=True).stdout.strip()
+
+
+def run_parallel(*funcs):
+    """Call independent dfx helpers concurrently (each one is a separate process), return results in order."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=len(funcs)) as ex:
+        futures = [ex.submit(f) for f in funcs]
+        return [f.result() for f in futures]
 
 
 class use_identity:
@@ -198,15 +456,15 @@ class use_identity:
         self.original_identity = None
 
     def __enter__(self):
-        if self.identity_name:
+        # Only remember the original when we actually switch, so __exit__ has nothing to undo otherwise
+        if self.identity_name and get_current_identity() != self.identity_name:
             self.original_identity = get_current_identity()
-            if self.original_identity != self.identity_name:
-                subprocess.run(["dfx", "identity", "use", self.identity_name], capture_output=True, check=True)
+            switch_identity(self.identity_name)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.original_identity and self.original_identity != self.identity_name:
-            subprocess.run(["dfx", "identity", "use", self.original_identity], capture_output=True, check=True)
+        if self.original_identity:
+            switch_identity(self.original_identity)
         return False
 
 
@@ -214,71 +472,106 @@ def cmd_id(args):
     """Identity management."""
     ensure_dfx()
     if args.action == "list":
-        current = subprocess.run(
-            ["dfx", "identity", "whoami"], capture_output=True, text=True, check=True
-        ).stdout.strip()
-        r = subprocess.run(["dfx", "identity", "list"], capture_output=True, text=True, check=True)
+        current, listing = run_parallel(get_current_identity, identity_list)
         ids = [
-            {"name": line.strip(), "active": line.strip() == current}
-            for line in r.stdout.strip().split("\n")
-            if line.strip()
+            {"name": line.strip(), "active": line.strip() == current} for line in listing.split("\n") if line.strip()
         ]
         output({"identities": ids, "current": current})
     elif args.action == "use":
-        subprocess.run(["dfx", "identity", "use", args.name], check=True)
+        _current_identity["name"] = None
+        run_dfx(["identity", "use", args.name], check=True)  # not captured: let dfx report errors itself
+        _principals.pop(args.name, None)
+        _current_identity["name"] = args.name
         output({"switched": args.name, "principal": principal()})
     elif args.action == "new":
-        subprocess.run(["dfx", "identity", "new", args.name], check=True)
+        run_dfx(["identity", "new", args.name], check=True)
         output({"created": args.name})
     elif args.action == "whoami":
-        output(
-            {
-                "identity": subprocess.run(
-                    ["dfx", "identity", "whoami"], capture_output=True, text=True, check=True
-                ).stdout.strip(),
-                "principal": principal(),
-            }
-        )
+        name, pid = run_parallel(get_current_identity, principal)
+        output({"identity": name, "principal": pid})
+
+
+# Candid argument templates for ledger and index calls, filled positionally with `%` (no brace escaping)
+BALANCE_ARG = '(record { owner = principal "%s"; subaccount = %s; })'  # owner, subaccount
+TRANSFER_ARG = (  # to, subaccount, amount, fee, memo, from_subaccount
+    '(record { to = record { owner = principal "%s"; subaccount = %s; }; amount = %d; fee = opt %d; '
+    "memo = %s; created_at_time = null; from_subaccount = %s; })"
+)
+MINT_ARG = (  # to, subaccount, amount
+    '(record { to = record { owner = principal "%s"; subaccount = %s; }; amount = %d : nat })'
+)
+ACCOUNT_TRANSACTIONS_ARG = (  # owner, limit
+    '(record { account = record { owner = principal "%s"; subaccount = null }; start = null; max_results = %d : nat })'
+)
+
+
+def _hex_bytes(s):
+    """Decode `s` as a hex string, or return None if it isn't one."""
+    try:
+        raw = bytes.fromhex(s)
+    except ValueError:
+        return None
+    # fromhex skips whitespace; only accept strings that are pure hex digits
+    return raw if len(raw) * 2 == len(s) else None
 
 
-def subaccount(s):
-    """Convert subaccount input to Candid blob format.
+def _blob(raw):
+    """Render bytes as the body of a Candid blob literal (one backslash-hex escape per byte)."""
+    # bytes.hex puts the separator *between* bytes in C; prefix the first escape ourselves
+    return "\\" + raw.hex("\\") if raw else ""
+
+
+# Inputs meaning "default subaccount" (Candid null)
+_DEFAULT_SUBACCOUNTS = (None, "", "0", 0)
+
+
+@functools.lru_cache(maxsize=256)
+def subaccount_bytes(s):
+    """Convert subaccount input to its 32 raw bytes, or None for the default subaccount (memoized).
 
     Accepts:
     - Integer (0-255): last byte of 32-byte blob
     - Hex string (64 chars): direct 32-byte blob
     - Arbitrary text: ASCII bytes, right-padded to 32 bytes
     """
-    if s is None or s == "" or s == "0" or s == 0:
-        return "null"
+    if s in _DEFAULT_SUBACCOUNTS:
+        return None
 
     # Try as integer first
     try:
         n = int(s)
         if 0 <= n <= 255:
-            blob = "\\00" * 31 + "\\{:02x}".format(n)
-            return f'opt blob "{blob}"'
+            return bytes(31) + bytes((n,))
     except (ValueError, TypeError):
         pass
 
     s = str(s)
 
     # 64-char hex string → direct 32 bytes
-    if len(s) == 64 and all(c in "0123456789abcdefABCDEF" for c in s):
-        blob = "".join(f"\\{s[i:i+2]}" for i in range(0, 64, 2))
-        return f'opt blob "{blob}"'
+    if len(s) == 64:
+        raw = _hex_bytes(s)
+        if raw is not None:
+            return raw
 
     # Arbitrary text → ASCII bytes, padded to 32 bytes
     raw = s.encode("ascii")
     if len(raw) > 32:
         raise ValueError(f"Subaccount text too long: {len(raw)} bytes (max 32)")
-    padded = raw.ljust(32, b"\x00")
-    blob = "".join(f"\\{b:02x}" for b in padded)
-    return f'opt blob "{blob}"'
+    return raw.ljust(32, b"\x00")
+
+
+@functools.lru_cache(maxsize=256)
+def subaccount(s):
+    """Convert subaccount input (see subaccount_bytes) to Candid blob format (memoized, inputs repeat across calls)."""
+    raw = subaccount_bytes(s)
+    if raw is None:
+        return "null"
+    return f'opt blob "{_blob(raw)}"'
 
 
+@functools.lru_cache(maxsize=256)
 def memo(s):
-    """Convert memo input to Candid blob format.
+    """Convert memo input to Candid blob format (memoized like subaccount).
 
     Accepts:
     - None/empty: returns null
@@ -291,20 +584,44 @@ def memo(s):
     s = str(s)
 
     # Hex string (non-empty, even length, all hex chars) → direct bytes
-    if len(s) > 0 and len(s) % 2 == 0 and len(s) <= 64 and all(c in "0123456789abcdefABCDEF" for c in s):
-        blob = "".join(f"\\{s[i:i+2]}" for i in range(0, len(s), 2))
-        return f'opt blob "{blob}"'
+    if len(s) <= 64:
+        raw = _hex_bytes(s)
+        if raw:
+            return f'opt blob "{_blob(raw)}"'
 
     # Arbitrary text → ASCII bytes
     raw = s.encode("ascii")
     if len(raw) > 32:
         raise ValueError(f"Memo too long: {len(raw)} bytes (max 32)")
-    blob = "".join(f"\\{b:02x}" for b in raw)
-    return f'opt blob "{blob}"'
+    return f'opt blob "{_blob(raw)}"'
+
+
+def parse_amount(amount, dec):
+    """Convert an amount string to base units exactly ("1.5" is in tokens, "150" is already base units)."""
+    whole, dot, frac = amount.strip().partition(".")
+    if not dot:
+        return int(whole)
+    if frac and not frac.isdigit():
+        raise ValueError(f"Invalid amount: {amount!r}")
+    # Shift the decimal point with string ops: exact for any precision, digits beyond `dec` are dropped
+    return int(whole + frac[:dec].ljust(dec, "0"))
+
+
+def icrc1_balance(ledger, owner, sa, network):
+    """Query an ICRC-1 balance, over HTTPS via the IC agent when installed, otherwise through dfx."""
+    from icw import agent
+
+    if agent.available(network):
+        import asyncio
+
+        return asyncio.run(agent.icrc1_balance_of(ledger, owner, subaccount_bytes(sa)))
+    return int(
+        dfx(["canister", "call", ledger, "icrc1_balance_of", BALANCE_ARG % (owner, subaccount(sa))], network) or 0
+    )
 
 
 def cmd_balance(args):
-    ledger, name, dec, _, cg_id = TOKENS[args.token]
+    ledger, name, _, _, cg_id = TOKENS[args.token]
     # Auto-detect local ledgers if on local network
     if args.network == "local" and not args.ledger:
         local_ledgers = detect_local_canisters()
@@ -313,23 +630,15 @@ def cmd_balance(args):
         ledger = args.ledger or ledger  # allow override for testing
 
     identity = getattr(args, "identity", None)
-    with use_identity(identity):
+
+    def lookup():
         p = args.principal or principal()
-        bal = int(
-            dfx(
-                [
-                    "canister",
-                    "call",
-                    ledger,
-                    "icrc1_balance_of",
-                    f'(record {{ owner = principal "{p}"; subaccount = {subaccount(args.subaccount)}; }})',
-                ],
-                args.network,
-            )
-            or 0
-        )
-    human = bal / 10**dec
-    price = get_usd_price(cg_id)
+        return p, icrc1_balance(ledger, p, args.subaccount, args.network)
+
+    with use_identity(identity):
+        # The price doesn't depend on the account, so fetch it while the principal and balance are looked up
+        (p, bal), price = run_parallel(lookup, functools.partial(get_usd_price, cg_id))
+    human = bal / TOKEN_SCALE[args.token]
     usd = round(human * price, 2) if price else None
     output({"token": name, "balance": human, "raw": bal, "usd": usd, "price": price, "principal": p})
 
@@ -343,7 +652,7 @@ def cmd_transfer(args):
     else:
         ledger = args.ledger or ledger  # allow override for testing
     fee = args.fee if args.fee is not None else fee  # allow override for testing
-    amt = int(float(args.amount) * 10**dec) if "." in args.amount else int(args.amount)
+    amt = parse_amount(args.amount, dec)
     memo_val = memo(args.memo) if hasattr(args, "memo") else "null"
 
     identity = getattr(args, "identity", None)
@@ -354,12 +663,13 @@ def cmd_transfer(args):
                 "call",
                 ledger,
                 "icrc1_transfer",
-                f'(record {{ to = record {{ owner = principal "{args.recipient}"; subaccount = {subaccount(args.subaccount)}; }}; amount = {amt}; fee = opt {fee}; memo = {memo_val}; created_at_time = null; from_subaccount = {subaccount(args.from_subaccount)}; }})',
+                TRANSFER_ARG
+                % (args.recipient, subaccount(args.subaccount), amt, fee, memo_val, subaccount(args.from_subaccount)),
             ],
             args.network,
         )
     result = (
-        {"ok": True, "block": r["Ok"], "token": name, "amount": amt / 10**dec, "to": args.recipient}
+        {"ok": True, "block": r["Ok"], "token": name, "amount": amt / TOKEN_SCALE[args.token], "to": args.recipient}
         if isinstance(r, dict) and "Ok" in r
         else None
     )
@@ -375,16 +685,16 @@ def cmd_transfer(args):
 
 def cmd_info(args):
     ledger, name, dec, fee, cg_id = TOKENS[args.token]
-    price = get_usd_price(cg_id)
+    price, p = run_parallel(functools.partial(get_usd_price, cg_id), principal)
     output(
         {
             "token": name,
             "ledger": ledger,
             "decimals": dec,
             "fee": fee,
-            "fee_human": fee / 10**dec,
+            "fee_human": fee / TOKEN_SCALE[args.token],
             "price_usd": price,
-            "principal": principal(),
+            "principal": p,
             "network": args.network,
         }
     )
@@ -401,7 +711,7 @@ def cmd_mint(args):
         ledger = args.ledger or ledger
 
     p = args.recipient or principal()
-    amt = int(float(args.amount) * 10**dec) if "." in args.amount else int(args.amount)
+    amt = parse_amount(args.amount, dec)
 
     r = dfx(
         [
@@ -409,7 +719,7 @@ def cmd_mint(args):
             "call",
             ledger,
             "mint",
-            f'(record {{ to = record {{ owner = principal "{p}"; subaccount = {subaccount(args.subaccount)}; }}; amount = {amt} : nat }})',
+            MINT_ARG % (p, subaccount(args.subaccount), amt),
         ],
         args.network,
     )
@@ -421,7 +731,7 @@ def cmd_mint(args):
                     "ok": True,
                     "block": r.get("block_index"),
                     "token": name,
-                    "amount": amt / 10**dec,
+                    "amount": amt / TOKEN_SCALE[args.token],
                     "to": p,
                     "new_balance": r.get("new_balance"),
                 }
@@ -457,7 +767,7 @@ def cmd_ui(args):
         ledgers["ckusdt"] = args.ckusdt_ledger
 
     if ledgers:
-        print(f"Auto-detected ledgers: {json.dumps(ledgers, indent=2)}")
+        print(f"Auto-detected ledgers: {json_dumps_pretty(ledgers)}")
 
     run_server(
         port=args.port,
@@ -469,7 +779,7 @@ def cmd_ui(args):
 
 def cmd_install_launcher(args):
     """Install desktop launcher (Linux only)."""
-    import os
+    import platform
     import shutil as sh
     from pathlib import Path
 
@@ -522,11 +832,13 @@ Keywords=crypto;wallet;bitcoin;ethereum;icp;
     print('\n✓ Launcher installed! Search for "ICW Wallet" in your applications menu.')
 
 
-def main():
+def build_parser():
+    """Build the `icw` argument parser; each subcommand sets `func` to its handler."""
     p = argparse.ArgumentParser(prog="icw", description="ICP Wallet CLI")
     p.add_argument("--version", "-v", action="version", version=f"%(prog)s {__version__}")
     p.add_argument("--network", "-n", default="ic")
     p.add_argument("--token", "-t", default="ckbtc", choices=TOKENS.keys())
+    p.add_argument("--pretty", action="store_true", help="Indent JSON output even when piped")
     sub = p.add_subparsers(dest="cmd", required=True)
 
     b = sub.add_parser("balance", aliases=["b"])
@@ -534,6 +846,7 @@ def main():
     b.add_argument("--subaccount", "-s", default="0")
     b.add_argument("--ledger", "-l", help="Override ledger canister ID")
     b.add_argument("--identity", "-i", help="dfx identity to use (temporarily switches)")
+    b.set_defaults(func=cmd_balance)
 
     t = sub.add_parser("transfer", aliases=["t"])
     t.add_argument("recipient")
@@ -544,18 +857,21 @@ def main():
     t.add_argument("--fee", type=int, help="Override transfer fee")
     t.add_argument("--memo", "-m", help="Transaction memo/tag (max 32 bytes)")
     t.add_argument("--identity", "-i", help="dfx identity to use (temporarily switches)")
+    t.set_defaults(func=cmd_transfer)
 
     m = sub.add_parser("mint", aliases=["m"], help="Mint tokens (NON-STANDARD)")
     m.add_argument("amount")
     m.add_argument("--recipient", "-r", help="Recipient principal (default: self)")
     m.add_argument("--subaccount", "-s", default="0")
     m.add_argument("--ledger", "-l", help="Override ledger canister ID")
+    m.set_defaults(func=cmd_mint)
 
-    sub.add_parser("info", aliases=["i"])
+    sub.add_parser("info", aliases=["i"]).set_defaults(func=cmd_info)
 
     i = sub.add_parser("id", help="Identity management")
     i.add_argument("action", choices=["list", "use", "new", "whoami"], nargs="?", default="whoami")
     i.add_argument("name", nargs="?", help="Identity name (for use/new)")
+    i.set_defaults(func=cmd_id)
 
     u = sub.add_parser("ui", help="Launch web UI")
     u.add_argument("--port", "-p", type=int, default=5555, help="Port to run on")
@@ -566,23 +882,19 @@ def main():
     u.add_argument("--icp-ledger", help="ICP ledger canister ID (for local)")
     u.add_argument("--ckusdc-ledger", help="ckUSDC ledger canister ID (for local)")
     u.add_argument("--ckusdt-ledger", help="ckUSDT ledger canister ID (for local)")
+    u.set_defaults(func=cmd_ui)
+
+    sub.add_parser("install-launcher", help="Install desktop launcher (Linux)").set_defaults(func=cmd_install_launcher)
+    return p
 
-    sub.add_parser("install-launcher", help="Install desktop launcher (Linux)")
 
-    args = p.parse_args()
-    {
-        "balance": cmd_balance,
-        "b": cmd_balance,
-        "transfer": cmd_transfer,
-        "t": cmd_transfer,
-        "mint": cmd_mint,
-        "m": cmd_mint,
-        "info": cmd_info,
-        "i": cmd_info,
-        "id": cmd_id,
-        "ui": cmd_ui,
-        "install-launcher": cmd_install_launcher,
-    }[args.cmd](args)
+def main(argv=None):
+    """Run the CLI on `argv` (default: sys.argv[1:]); returns the exit code, errors exit via SystemExit."""
+    args = build_parser().parse_args(argv)
+    if args.pretty:
+        _output["pretty"] = True
+    args.func(args)
+    return 0
 
 
 def ui():
@@ -595,4 +907,4 @@ def ui():
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""ICW price cache - CoinGecko USD prices kept on disk between CLI runs.
+
+Every `icw` command is a fresh process, so an in-memory cache never hits for the CLI.
+Prices live in ~/.cache/icw/prices.json (honours XDG_CACHE_HOME) for ICW_PRICE_TTL
+seconds, 10 minutes by default. Cache problems are never fatal: a broken or unwritable
+file just means prices get fetched again.
+"""
+
+import contextlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    import orjson  # optional: faster JSON (pip install internet-computer-wallet[fast])
+except ImportError:
+    orjson = None
+
+_prices = {"data": None}  # file contents, read at most once per process
+
+
+def cache_path():
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "icw" / "prices.json"
+
+
+def ttl():
+    return int(os.getenv("ICW_PRICE_TTL", "600"))
+
+
+def _load():
+    if _prices["data"] is None:
+        try:
+            raw = cache_path().read_bytes()
+            data = orjson.loads(raw) if orjson else json.loads(raw)
+        except Exception:
+            data = {}
+        _prices["data"] = data if isinstance(data, dict) else {}
+    return _prices["data"]
+
+
+def get(coingecko_id):
+    """Cached USD price for `coingecko_id`, or None if missing or older than the TTL."""
+    try:
+        ts, price = _load()[coingecko_id]
+        fresh = time.time() - ts < ttl()
+    except (KeyError, TypeError, ValueError):
+        return None
+    return price if fresh else None
+
+
+def put(prices):
+    """Store {coingecko_id: price} (None prices are skipped) and rewrite the file atomically."""
+    now = time.time()
+    data = _load()
+    data.update({cg_id: [now, price] for cg_id, price in prices.items() if price is not None})
+    path = cache_path()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(data) if orjson else json.dumps(data).encode())
+        os.replace(tmp, path)  # readers see the old file or the new one, never half of one
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
@@ -5,11 +5,41 @@ import sys
 
 sys.path.insert(0, "src")
 
+import contextlib
+import types
+from unittest import mock
+
 from fastapi.testclient import TestClient
+import icw.api as api
+import icw.cli as cli
 from icw.api import app
 
 client = TestClient(app)
 
+# Canned dfx and CoinGecko answers, so the suite needs neither dfx installed nor network access
+FAKE_DFX = {
+    ("identity", "whoami"): "default",
+    ("identity", "list"): "anonymous\ndefault",
+    ("identity", "get-principal"): "aaaaa-aa",
+}
+FAKE_PRICE = 1.5
+
+
+@contextlib.contextmanager
+def fakes():
+    """Route dfx and CoinGecko calls made by the app to the canned answers above, for the duration of the run."""
+
+    async def fake_run_dfx_async(args):
+        return (FAKE_DFX.get(tuple(args), "") + "\n").encode()
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.dict(cli._dfx, path="/fake/dfx"))  # also keeps ensure_dfx from prompting
+        for module in (cli, api):
+            stack.enter_context(mock.patch.object(module, "run_dfx_async", fake_run_dfx_async))
+        prices = {cg_id: {"usd": FAKE_PRICE} for cg_id in cli.COINGECKO_IDS}
+        stack.enter_context(mock.patch.object(cli, "coingecko_get", lambda path: prices))
+        yield
+
 
 def test_index_returns_html():
     """Home page should return HTML."""
@@ -23,29 +53,33 @@ def test_index_returns_html():
 def test_api_identity():
     """Identity endpoint should return current identity."""
     response = client.get("/api/identity")
-    # May return 500 if dfx identity not set up in CI
-    if response.status_code == 500:
-        print("⚠ test_api_identity (skipped - dfx not configured)")
-        return
     assert response.status_code == 200
     data = response.json()
-    assert "identity" in data
-    assert "principal" in data
+    assert data["identity"] == "default"
+    assert data["principal"] == "aaaaa-aa"
+    # Principal is cached after the first lookup
+    assert client.get("/api/identity").json()["principal"] == data["principal"]
+
+    # `dfx identity use` run in a terminal shows up on the next request
+    FAKE_DFX[("identity", "whoami")], FAKE_DFX[("identity", "get-principal")] = "alice", "2vxsx-fae"
+    try:
+        assert client.get("/api/identity").json() == {"identity": "alice", "principal": "2vxsx-fae"}
+    finally:
+        FAKE_DFX[("identity", "whoami")], FAKE_DFX[("identity", "get-principal")] = "default", "aaaaa-aa"
+        cli._principals.pop("alice", None)
+    assert client.get("/api/identity").json()["principal"] == "aaaaa-aa"
     print("✓ test_api_identity")
 
 
 def test_api_identities():
     """Identities endpoint should list all identities."""
     response = client.get("/api/identities")
-    # May return 500 if dfx identity not set up in CI
-    if response.status_code == 500:
-        print("⚠ test_api_identities (skipped - dfx not configured)")
-        return
     assert response.status_code == 200
     data = response.json()
     assert "identities" in data
-    assert "current" in data
+    assert data["current"] == "default"
     assert isinstance(data["identities"], list)
+    assert [i["name"] for i in data["identities"]] == ["anonymous", "default"]
     print("✓ test_api_identities")
 
 
@@ -56,6 +90,102 @@ def test_api_balance_invalid_token():
     print("✓ test_api_balance_invalid_token")
 
 
+def test_api_dfx_failure():
+    """A failing dfx call should come back as a 500, not stop the server."""
+
+    async def failing_run_dfx_async(args):
+        raise RuntimeError("Error: canister not found")
+
+    real = cli.run_dfx_async
+    cli.run_dfx_async = failing_run_dfx_async
+    try:
+        response = client.get("/api/balance/ckbtc?network=local&ledger=aaaaa-aa")
+    finally:
+        cli.run_dfx_async = real
+    assert response.status_code == 500
+    assert response.json()["detail"] == "Error: canister not found"
+    print("✓ test_api_dfx_failure")
+
+
+def test_api_transactions_skip_malformed():
+    """An index entry that doesn't parse is skipped, the rest of the history is still returned."""
+    good = {
+        "id": "1_000",
+        "transaction": {"kind": "mint", "timestamp": 5, "mint": [{"to": {"owner": "a"}, "amount": 7}]},
+    }
+    reply = {"Ok": {"transactions": [good, {"id": "not a nat"}, "junk", {"transaction": {}}]}}
+
+    async def index_reply(args):
+        return cli.json_dumps_bytes(reply)
+
+    real = cli.run_dfx_async
+    cli.run_dfx_async = index_reply
+    try:
+        response = client.get("/api/transactions/ckbtc?account=aaaaa-aa&network=local&index=aaaaa-aa")
+    finally:
+        cli.run_dfx_async = real
+    assert response.status_code == 200
+    assert [(tx["block"], tx["to"], tx["amount_raw"]) for tx in response.json()["transactions"]] == [(1000, "a", 7)]
+    print("✓ test_api_transactions_skip_malformed")
+
+
+def test_agent_balance_of():
+    """IC agent balance queries: subaccount encoding, reply conversion, rejects, and when the API uses them.
+
+    ic-py's encoder and the agent are stubbed, so this runs whether or not the agent extra is installed.
+    """
+    import asyncio
+
+    from icw import agent
+
+    queries, replies = [], []
+
+    class FakeAgent:
+        async def query_raw_async(self, canister_id, method, arg):
+            queries.append((canister_id, method, arg))
+            return replies.pop(0)
+
+    stubbed = ("Agent", "Types", "encode", "_agent")
+    saved = {name: getattr(agent, name) for name in stubbed if hasattr(agent, name)}
+    agent.Types = types.SimpleNamespace(
+        Record=lambda fields: "Account", Opt=lambda t: t, Vec=lambda t: t, Principal=None, Nat8=None
+    )
+    agent.encode = lambda params: params[0]["value"]  # the candid value stands in for the encoded bytes
+    agent.Agent, agent._agent = object, FakeAgent()
+    try:
+        sa = bytes(range(32))
+        replies[:] = [[{"type": "nat", "value": 12}], [{"type": "nat", "value": 2**70}]]
+        assert asyncio.run(agent.icrc1_balance_of("ledger-id", "aaaaa-aa")) == 12
+        assert asyncio.run(agent.icrc1_balance_of("ledger-id", "aaaaa-aa", sa)) == 2**70  # beyond 64 bits
+        assert queries == [
+            ("ledger-id", "icrc1_balance_of", {"owner": "aaaaa-aa", "subaccount": []}),  # default account: null
+            ("ledger-id", "icrc1_balance_of", {"owner": "aaaaa-aa", "subaccount": [sa]}),
+        ]
+
+        replies[:] = ["canister rejected the query"]
+        try:
+            asyncio.run(agent.icrc1_balance_of("ledger-id", "aaaaa-aa"))
+            raise AssertionError("a reject should raise")
+        except RuntimeError as e:
+            assert "canister rejected the query" in str(e)
+
+        # The API takes the agent path on mainnet only; a local replica still goes through dfx
+        assert agent.available("ic") and not agent.available("local")
+        queries.clear()
+        replies[:] = [[{"type": "nat", "value": 5}]]
+        assert asyncio.run(api.balance_of("ledger-id", "aaaaa-aa", "ic", "1")) == 5
+        assert queries[0][2]["subaccount"] == [cli.subaccount_bytes("1")]
+        assert asyncio.run(api.balance_of("ledger-id", "aaaaa-aa", "local", "1")) == 0  # fake dfx: empty reply
+        assert len(queries) == 1
+    finally:
+        for name in stubbed:
+            if name in saved:
+                setattr(agent, name, saved[name])
+            else:
+                delattr(agent, name)
+    print("✓ test_agent_balance_of")
+
+
 def test_api_info():
     """Info endpoint should return token details."""
     response = client.get("/api/info/ckbtc")
@@ -112,6 +242,8 @@ def test_api_prices():
         assert token in data["prices"]
         assert "name" in data["prices"][token]
         assert "coingecko_id" in data["prices"][token]
+        assert data["prices"][token]["price"] == FAKE_PRICE
+    assert data["prices"]["realms"]["price"] is None  # not listed on CoinGecko
     print("✓ test_api_prices")
 
 
@@ -126,24 +258,96 @@ def test_api_config():
     print("✓ test_api_config")
 
 
+def test_api_etag():
+    """Polled endpoints should answer 304 when the client's ETag is current."""
+    for url in ["/api/config", "/api/prices"]:
+        first = client.get(url)
+        etag = first.headers["etag"]
+        assert first.headers["cache-control"] == "private, no-cache", "clients must revalidate every poll"
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304, f"{url} should return 304 for a matching ETag"
+    print("✓ test_api_etag")
+
+
 def test_api_logo():
     """Logo endpoint should return image."""
     response = client.get("/logo.png")
     assert response.status_code == 200
     assert "image/png" in response.headers["content-type"]
+    assert response.headers["cache-control"] == "public, max-age=86400"  # unversioned URL: not immutable
     print("✓ test_api_logo")
 
 
+def test_gather_limited():
+    """Balance fan-outs keep call order and never run more than ICW_DFX_WORKERS dfx calls at once."""
+    import asyncio
+
+    running, peak = [0], [0]
+
+    async def call(i):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        await asyncio.sleep(0)
+        running[0] -= 1
+        return i
+
+    n = api.DFX_WORKERS * 3
+    assert asyncio.run(api.gather_limited([call(i) for i in range(n)])) == list(range(n))
+    assert peak[0] == api.DFX_WORKERS
+    print("✓ test_gather_limited")
+
+
+def test_nat_parsing():
+    """Candid nats should parse with or without digit separators."""
+    from icw.api import _nat
+
+    assert _nat("100_000_000") == 100_000_000
+    assert _nat("42") == 42
+    assert _nat(7) == 7
+    print("✓ test_nat_parsing")
+
+
+def test_parse_tx_operation():
+    """Index canister operations should map to (from, to, amount) by kind."""
+    from icw.api import _parse_tx_operation
+
+    transfer = {"transfer": [{"from": {"owner": "a"}, "to": {"owner": "b"}, "amount": "1_000"}]}
+    assert _parse_tx_operation(transfer, "transfer") == ("a", "b", 1000)
+    assert _parse_tx_operation({"mint": [{"to": {"owner": "b"}, "amount": "5"}]}, "mint") == (None, "b", 5)
+    assert _parse_tx_operation({"burn": {"from": {"owner": "a"}, "amount": 7}}, "burn") == ("a", None, 7)
+    assert _parse_tx_operation({"approve": [{}]}, "approve") == (None, None, 0)
+    print("✓ test_parse_tx_operation")
+
+
+def test_json_response_big_ints():
+    """Raw amounts beyond 64 bits (large ckETH balances) must still serialize."""
+    from icw.api import ORJSONResponse
+
+    assert ORJSONResponse({"raw": 10**21}).body == b'{"raw":1000000000000000000000}'
+    print("✓ test_json_response_big_ints")
+
+
 if __name__ == "__main__":
-    test_index_returns_html()
-    test_api_identity()
-    test_api_identities()
-    test_api_balance_invalid_token()
-    test_api_info()
-    test_api_info_all_tokens()
-    test_api_transfer_missing_fields()
-    test_api_transfer_invalid_token()
-    test_api_prices()
-    test_api_config()
-    test_api_logo()
+    # Entering the client runs the app lifespan once and keeps one event loop for every
+    # request, instead of TestClient starting a fresh portal thread per call
+    with fakes(), client:
+        test_index_returns_html()
+        test_api_identity()
+        test_api_identities()
+        test_api_balance_invalid_token()
+        test_api_dfx_failure()
+        test_api_transactions_skip_malformed()
+        test_agent_balance_of()
+        test_api_info()
+        test_api_info_all_tokens()
+        test_api_transfer_missing_fields()
+        test_api_transfer_invalid_token()
+        test_api_prices()
+        test_api_config()
+        test_api_etag()
+        test_api_logo()
+        test_gather_limited()
+        test_nat_parsing()
+        test_parse_tx_operation()
+        test_json_response_big_ints()
     print("\nAll API tests passed!")
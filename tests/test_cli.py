@@ -1,23 +1,29 @@
 #!/usr/bin/env python3
 """Tests for ICW CLI - plain Python, no frameworks."""
 
+import argparse
 import sys
 
 sys.path.insert(0, "src")
 
-from icw.cli import TOKENS, subaccount, memo, normalize_candid_response, CANDID_HASH_MAP
+from icw.cli import (
+    TOKENS,
+    subaccount,
+    memo,
+    normalize_candid_response,
+    parse_amount,
+    run_parallel,
+    subaccount_bytes,
+    CANDID_HASH_MAP,
+)
 
 
 def test_tokens():
-    assert "ckbtc" in TOKENS, "ckbtc should be in TOKENS"
-    assert "cketh" in TOKENS, "cketh should be in TOKENS"
-    assert "icp" in TOKENS, "icp should be in TOKENS"
-    assert "ckusdc" in TOKENS, "ckusdc should be in TOKENS"
-    assert "ckusdt" in TOKENS, "ckusdt should be in TOKENS"
+    missing = {"ckbtc", "cketh", "icp", "ckusdc", "ckusdt"} - TOKENS.keys()
+    assert not missing, f"missing tokens: {missing}"
     assert TOKENS["ckbtc"][0] == "mxzaz-hqaaa-aaaar-qaada-cai"
-    assert TOKENS["ckbtc"][2] == 8  # decimals
-    assert TOKENS["ckusdc"][2] == 6  # stablecoins have 6 decimals
-    assert TOKENS["ckusdt"][2] == 6  # stablecoins have 6 decimals
+    # decimals: stablecoins have 6
+    assert [TOKENS[t][2] for t in ("ckbtc", "ckusdc", "ckusdt")] == [8, 6, 6]
     print("✓ test_tokens")
 
 
@@ -26,6 +32,11 @@ def test_subaccount():
     assert "opt blob" in subaccount(1)
     assert "\\01" in subaccount(1)
     assert "\\ff" in subaccount(255)
+    # Raw form, as sent by the IC agent
+    assert subaccount_bytes("0") is None
+    assert subaccount_bytes(1) == bytes(31) + b"\x01"
+    assert subaccount_bytes("ab" * 32) == b"\xab" * 32
+    assert subaccount_bytes("savings") == b"savings".ljust(32, b"\x00")
     print("✓ test_subaccount")
 
 
@@ -61,12 +72,93 @@ def test_memo():
     print("✓ test_memo")
 
 
+def test_parse_amount():
+    assert parse_amount("1.5", 8) == 150_000_000
+    assert parse_amount("150", 8) == 150  # no decimal point: already base units
+    # 18-decimal amounts must not lose digits to float rounding
+    assert parse_amount("1.000000000000000001", 18) == 1_000_000_000_000_000_001
+    assert parse_amount("0.123456789", 8) == 12_345_678  # excess precision truncates
+    assert parse_amount(".5", 8) == 50_000_000
+    assert parse_amount("2.", 6) == 2_000_000
+    print("✓ test_parse_amount")
+
+
+def test_run_parallel():
+    import threading
+
+    # Each call only gets past the barrier once the other one is running too (BrokenBarrierError otherwise)
+    barrier = threading.Barrier(2, timeout=10)
+
+    def call(value):
+        barrier.wait()
+        return value
+
+    result = run_parallel(lambda: call("a"), lambda: call("b"))
+    assert result == ["a", "b"]  # results keep call order
+    print("✓ test_run_parallel")
+
+
+def test_use_identity():
+    import icw.cli as cli
+
+    calls = []
+    real_run = cli.subprocess.run
+    cli.subprocess.run = lambda cmd, **kw: calls.append(cmd[2:])
+    try:
+        cli._current_identity["name"] = "alice"
+        with cli.use_identity("alice"):
+            pass
+        assert calls == []  # already active: no whoami, no switch
+        with cli.use_identity("bob"):
+            assert cli.get_current_identity() == "bob"
+        assert calls == [["use", "bob"], ["use", "alice"]]
+        assert cli.get_current_identity() == "alice"
+    finally:
+        cli.subprocess.run = real_run
+        cli._current_identity["name"] = None
+    print("✓ test_use_identity")
+
+
+def test_principal_cache():
+    import types
+    import icw.cli as cli
+
+    calls = []
+    real_run = cli.subprocess.run
+
+    def fake_run(cmd, **kw):
+        calls.append(cmd[2:])
+        return types.SimpleNamespace(stdout=f"principal-of-{cli._current_identity['name']}\n")
+
+    cli.subprocess.run = fake_run
+    try:
+        cli._principals.clear()
+        cli._current_identity["name"] = "alice"
+        assert cli.principal() == cli.principal() == "principal-of-alice"
+        assert calls == [["get-principal"]], "Second lookup should be cached"
+        cli._current_identity["name"] = "bob"
+        assert cli.principal() == "principal-of-bob", "Each identity has its own principal"
+    finally:
+        cli.subprocess.run = real_run
+        cli._principals.clear()
+        cli._current_identity["name"] = None
+    print("✓ test_principal_cache")
+
+
 def test_token_structure():
-    for name, (ledger, symbol, decimals, fee, cg_id) in TOKENS.items():
-        assert ledger.endswith("-cai"), f"{name} ledger should end with -cai"
-        assert decimals > 0, f"{name} should have positive decimals"
-        assert fee >= 0, f"{name} should have non-negative fee"
-        assert cg_id or name == "realms", f"{name} should have coingecko id"
+    # Collect every broken row so one run reports them all
+    bad = [
+        (name, problem)
+        for name, (ledger, symbol, decimals, fee, cg_id) in TOKENS.items()
+        for problem, ok in [
+            ("ledger should end with -cai", ledger.endswith("-cai")),
+            ("decimals should be positive", decimals > 0),
+            ("fee should be non-negative", fee >= 0),
+            ("should have coingecko id", cg_id or name == "realms"),
+        ]
+        if not ok
+    ]
+    assert not bad, bad
     print("✓ test_token_structure")
 
 
@@ -96,31 +188,158 @@ def test_detect_local_canisters():
         assert result.get("ckbtc") == "bkyz2-fmaaa-aaaaa-qaaaq-cai"
         assert result.get("icp") == "ryjl3-tyaaa-aaaaa-aaaba-cai"
 
+        # Parses are cached by mtime: a redeploy that rewrites the file is picked up
+        canister_ids["ckbtc_ledger"] = {"local": "mxzaz-hqaaa-aaaar-qaada-cai"}
+        with open("canister_ids.json", "w") as f:
+            json.dump(canister_ids, f)
+        os.utime("canister_ids.json", ns=(0, os.stat("canister_ids.json").st_mtime_ns + 1))
+        assert detect_local_canisters()["ckbtc"] == "mxzaz-hqaaa-aaaar-qaada-cai"
+
         os.chdir(original_cwd)
     print("✓ test_detect_local_canisters")
 
 
 def test_price_cache():
     """Test that price caching works correctly."""
-    from icw.cli import get_all_prices, _price_cache
+    from icw import cli
+
+    calls = []
+    real_fetch = cli.fetch_usd_prices
+    cli.fetch_usd_prices = lambda ids: calls.append(ids) or dict.fromkeys(ids, 1.0)
+    try:
+        cli._usd_price_cache.clear()
+        assert cli.get_all_prices() == dict.fromkeys(cli.COINGECKO_IDS, 1.0)
+
+        # Second call within 30 seconds should return cached data
+        cli.get_all_prices()
+        assert len(calls) == 1, calls
+
+        # Past the 30 seconds the prices are fetched again, still in one request
+        for cg_id, (ts, price) in cli._usd_price_cache.items():
+            cli._usd_price_cache[cg_id] = (ts - 30, price)
+        cli.get_all_prices()
+        assert len(calls) == 2, calls
+
+        # A failed fetch for another coin keeps the fresh prices of the listed ones
+        cli.fetch_usd_prices = lambda ids: calls.append(ids) or 1 / 0
+        assert cli.cached_usd_price("custom-coin") is None
+        assert cli.get_all_prices() == dict.fromkeys(cli.COINGECKO_IDS, 1.0)
+        assert len(calls) == 3, calls
+
+        # On a cold cache it leaves every price unknown without retrying once per coin
+        cli._usd_price_cache.clear()
+        assert cli.get_all_prices() == dict.fromkeys(cli.COINGECKO_IDS)
+        assert len(calls) == 4, calls
+    finally:
+        cli.fetch_usd_prices = real_fetch
+        cli._usd_price_cache.clear()
+    print("✓ test_price_cache")
+
+
+def test_cached_usd_price():
+    """Test that per-coin prices are served from cache within the TTL."""
+    from icw.cli import cached_usd_price, _usd_price_cache
     import time
 
-    # Clear cache
-    _price_cache["data"] = {}
-    _price_cache["timestamp"] = 0
+    _usd_price_cache["fake-coin"] = (time.monotonic(), 42.0)
+    assert cached_usd_price("fake-coin") == 42.0, "Fresh entry should be served from cache"
+    _usd_price_cache.pop("fake-coin")
+
+    # A miss prices all listed tokens with one request
+    import icw.cli as cli
 
-    # First call should try to fetch (may fail due to rate limits, that's ok)
-    get_all_prices()
-    timestamp1 = _price_cache["timestamp"]
+    real_fetch = cli.fetch_usd_prices
+    fetched = []
+    cli.fetch_usd_prices = lambda ids: fetched.append(ids) or dict.fromkeys(ids, 1.0)
+    try:
+        _usd_price_cache.clear()
+        assert [cached_usd_price(cg_id) for cg_id in cli.COINGECKO_IDS] == [1.0] * len(cli.COINGECKO_IDS)
+        assert fetched == [cli.COINGECKO_IDS]
+    finally:
+        cli.fetch_usd_prices = real_fetch
+        _usd_price_cache.clear()
+    print("✓ test_cached_usd_price")
+
+
+def test_unlisted_token_price():
+    """Tokens without a CoinGecko id (REALMS) get no price and no HTTP request."""
+    import icw.cli as cli
+
+    requests = []
+    real_get = cli.coingecko_get
+    cli.coingecko_get = requests.append
+    try:
+        assert cli.get_usd_price(TOKENS["realms"][4]) is None
+    finally:
+        cli.coingecko_get = real_get
+    assert requests == []
+    print("✓ test_unlisted_token_price")
 
-    # Second call within 30 seconds should return cached data
-    time.sleep(0.1)
-    get_all_prices()
-    timestamp2 = _price_cache["timestamp"]
 
-    # Timestamps should be the same (cache hit)
-    assert timestamp1 == timestamp2, "Cache should be used for second call"
-    print("✓ test_price_cache")
+def test_price_disk_cache():
+    """Test that CLI prices persist on disk and expire after ICW_PRICE_TTL."""
+    import os
+    import tempfile
+    import icw.cli as cli
+    from icw import pricecache
+
+    old_env = {k: os.environ.get(k) for k in ("XDG_CACHE_HOME", "ICW_PRICE_TTL")}
+    real_fetch = cli.fetch_usd_prices
+    fetched = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ["XDG_CACHE_HOME"] = tmpdir
+        pricecache._prices["data"] = None
+        cli.fetch_usd_prices = lambda ids: fetched.append(ids) or dict.fromkeys(ids, 42.0)
+        try:
+            assert cli.get_usd_price("fake-coin") == 42.0
+            assert cli.get_usd_price("fake-coin") == 42.0
+            assert cli.get_usd_price("bitcoin") == 42.0
+            # One request priced the asked-for coin and every listed token
+            assert fetched == [cli.COINGECKO_IDS + ("fake-coin",)], "Later lookups should be served from cache"
+
+            # A new process reads the file written by the first one
+            pricecache._prices["data"] = None
+            assert pricecache.get("fake-coin") == 42.0
+            assert os.path.exists(os.path.join(tmpdir, "icw", "prices.json"))
+
+            os.environ["ICW_PRICE_TTL"] = "0"
+            assert pricecache.get("fake-coin") is None, "Expired entry should not be served"
+        finally:
+            cli.fetch_usd_prices = real_fetch
+            pricecache._prices["data"] = None
+            for k, v in old_env.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+    print("✓ test_price_disk_cache")
+
+
+def test_output_format():
+    """Test JSON output is indented for people and compact when piped."""
+    import io
+    from icw import cli
+
+    data = {"token": "ckBTC", "raw": 2**70}  # beyond 64 bits: orjson falls back to the stdlib
+    old_stdout, old_pretty = sys.stdout, cli._output["pretty"]
+    try:
+        for pretty, expected in [(True, cli.json_dumps_pretty(data)), (False, '{"token":"ckBTC","raw":%d}' % 2**70)]:
+            cli._output["pretty"] = pretty
+            sys.stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+            cli.output(data)
+            written = sys.stdout.buffer.getvalue().decode()
+            assert written == expected + "\n", written
+            assert cli.json_loads(written) == data
+    finally:
+        sys.stdout, cli._output["pretty"] = old_stdout, old_pretty
+    print("✓ test_output_format")
+
+
+def _subcommands():
+    """The `icw` parser's subcommand action (choices maps commands and aliases to subparsers)."""
+    from icw.cli import build_parser
+
+    return next(a for a in build_parser()._actions if isinstance(a, argparse._SubParsersAction))
 
 
 def test_mint_command_exists():
@@ -130,25 +349,28 @@ def test_mint_command_exists():
     # Verify cmd_mint function exists and is callable
     assert callable(cmd_mint), "cmd_mint should be callable"
 
-    # Verify mint is in the parser by checking help output
-    import subprocess
-
-    result = subprocess.run(["icw", "mint", "--help"], capture_output=True, text=True)
-    assert result.returncode == 0, f"mint --help should succeed: {result.stderr}"
-    assert "amount" in result.stdout.lower(), "mint should have amount argument"
-    assert "recipient" in result.stdout.lower(), "mint should have recipient option"
-    assert "ledger" in result.stdout.lower(), "mint should have ledger option"
+    # Verify mint is in the parser and wired to cmd_mint
+    mint = _subcommands().choices["mint"]
+    assert mint.get_default("func") is cmd_mint, "mint should dispatch to cmd_mint"
+    dests = {a.dest for a in mint._actions}
+    assert "amount" in dests, "mint should have amount argument"
+    assert "recipient" in dests, "mint should have recipient option"
+    assert "ledger" in dests, "mint should have ledger option"
+    assert "--recipient" in mint.format_help(), "mint help should list --recipient"
     print("✓ test_mint_command_exists")
 
 
 def test_mint_command_args():
     """Test mint command argument parsing."""
-    import subprocess
+    from icw.cli import build_parser
 
     # Test 'm' alias works
-    result = subprocess.run(["icw", "m", "--help"], capture_output=True, text=True)
-    assert result.returncode == 0, f"mint alias 'm' should work: {result.stderr}"
-    assert "NON-STANDARD" in result.stdout or "amount" in result.stdout.lower(), "should show mint help"
+    sub = _subcommands()
+    assert sub.choices["m"] is sub.choices["mint"], "'m' should alias mint"
+    help_line = next(a.help for a in sub._choices_actions if a.dest == "mint")
+    assert "NON-STANDARD" in help_line, "should show mint help"
+    args = build_parser().parse_args(["m", "1.5", "-r", "abc-xyz"])
+    assert (args.amount, args.recipient, args.subaccount) == ("1.5", "abc-xyz", "0")
     print("✓ test_mint_command_args")
 
 
@@ -159,46 +381,31 @@ def test_normalize_candid_response():
     when the .did file is not available (e.g., calling a canister from icw without
     the local Candid interface).
     """
-    # Test MintResult hash keys -> field names
-    raw_response = {
-        "3_092_129_219": True,
-        "624_086_880": ["1"],
-        "2_825_987_837": ["100_000_000"],
-        "1_932_118_984": [],
-    }
-    normalized = normalize_candid_response(raw_response)
-
-    assert "success" in normalized, f"Expected 'success' field, got {normalized.keys()}"
-    assert "block_index" in normalized, f"Expected 'block_index' field, got {normalized.keys()}"
-    assert "new_balance" in normalized, f"Expected 'new_balance' field, got {normalized.keys()}"
-    assert "error" in normalized, f"Expected 'error' field, got {normalized.keys()}"
-
-    assert normalized["success"] is True
-    assert normalized["block_index"] == ["1"]
-    assert normalized["new_balance"] == ["100_000_000"]
-    assert normalized["error"] == []
-
-    # Test nested structures
-    nested = {"outer": {"3_092_129_219": True}}
-    normalized_nested = normalize_candid_response(nested)
-    assert normalized_nested["outer"]["success"] is True
-
-    # Test lists with dicts
-    list_response = [{"3_092_129_219": False}, {"624_086_880": ["2"]}]
-    normalized_list = normalize_candid_response(list_response)
-    assert normalized_list[0]["success"] is False
-    assert normalized_list[1]["block_index"] == ["2"]
-
-    # Test that unknown keys are preserved
-    unknown = {"unknown_key": "value", "3_092_129_219": True}
-    normalized_unknown = normalize_candid_response(unknown)
-    assert normalized_unknown["unknown_key"] == "value"
-    assert normalized_unknown["success"] is True
-
-    # Test primitives pass through unchanged
-    assert normalize_candid_response("string") == "string"
-    assert normalize_candid_response(123) == 123
-    assert normalize_candid_response(None) is None
+    cases = [
+        # MintResult hash keys -> field names
+        (
+            {"3_092_129_219": True, "624_086_880": ["1"], "2_825_987_837": ["100_000_000"], "1_932_118_984": []},
+            {"success": True, "block_index": ["1"], "new_balance": ["100_000_000"], "error": []},
+        ),
+        # Nested structures
+        ({"outer": {"3_092_129_219": True}}, {"outer": {"success": True}}),
+        # Lists with dicts
+        ([{"3_092_129_219": False}, {"624_086_880": ["2"]}], [{"success": False}, {"block_index": ["2"]}]),
+        # Unknown keys are preserved
+        ({"unknown_key": "value", "3_092_129_219": True}, {"unknown_key": "value", "success": True}),
+        # Primitives pass through unchanged
+        ("string", "string"),
+        (123, 123),
+        (None, None),
+    ]
+    for raw, expected in cases:
+        normalized = normalize_candid_response(raw)
+        assert normalized == expected, f"{raw!r}: expected {expected!r}, got {normalized!r}"
+
+    # Field order survives renaming; responses without hash keys are not copied
+    assert list(normalize_candid_response({"a": 1, "3_092_129_219": True, "z": 2})) == ["a", "success", "z"]
+    plain = {"Ok": [{"amount": "1"}]}
+    assert normalize_candid_response(plain) is plain
 
     print("✓ test_normalize_candid_response")
 
@@ -218,9 +425,17 @@ if __name__ == "__main__":
     test_tokens()
     test_subaccount()
     test_memo()
+    test_parse_amount()
+    test_run_parallel()
+    test_use_identity()
+    test_principal_cache()
     test_token_structure()
     test_detect_local_canisters()
     test_price_cache()
+    test_cached_usd_price()
+    test_unlisted_token_price()
+    test_price_disk_cache()
+    test_output_format()
     test_mint_command_exists()
     test_mint_command_args()
     test_normalize_candid_response()
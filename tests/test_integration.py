@@ -1,33 +1,105 @@
 #!/usr/bin/env python3
 """Integration tests with local ckBTC ledger canister."""
 
-import json
+import atexit
+import contextlib
+import functools
+import io
 import os
 import subprocess
 import sys
+import tempfile
 import time
+import types
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
 
+from icw import cli
+from icw.cli import json_loads  # orjson when installed, like the CLI itself
+
 NETWORK = "local"
 TEST_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
 def run(cmd, check=True):
+    return finish(start(cmd), check)
+
+
+def start(cmd, capture=True):
+    """Launch `cmd` without waiting for it; pair with finish(). Without `capture`, stdout is discarded."""
     print(f"$ {' '.join(cmd)}")
-    r = subprocess.run(cmd, capture_output=True, text=True, cwd=TEST_DIR)
-    if check and r.returncode != 0:
-        print(f"STDERR: {r.stderr}")
-        raise RuntimeError(f"Command failed: {r.returncode}")
-    return r.stdout.strip()
+    stdout = subprocess.PIPE if capture else subprocess.DEVNULL
+    return subprocess.Popen(cmd, stdout=stdout, stderr=subprocess.PIPE, text=True, cwd=TEST_DIR)
+
 
+def finish(proc, check=True):
+    """Wait for a start()ed command and return its stdout."""
+    stdout, stderr = proc.communicate()
+    if check and proc.returncode != 0:
+        print(f"STDERR: {stderr}")
+        raise RuntimeError(f"Command failed: {proc.returncode}")
+    return (stdout or "").strip()
 
+
+# The identity and canister IDs don't change once deployed, so ask dfx only once for each
+@functools.cache
 def get_principal():
     return run(["dfx", "identity", "get-principal"])
 
 
+@functools.cache
+def canister_id(name):
+    return run(["dfx", "canister", "id", name])
+
+
+def replica_running():
+    """Whether the local replica is up, reading dfx's pidfile before paying for a `dfx ping`."""
+    # dfx.json defines the local network here, so dfx keeps its state under tests/.dfx
+    try:
+        with open(os.path.join(TEST_DIR, ".dfx", "network", "local", "pid")) as f:
+            os.kill(int(f.read()), 0)  # signal 0: only checks the process exists
+        return True
+    except (OSError, ValueError):
+        pass  # no pidfile, or one left behind by a replica that has exited
+    return dfx_ping()
+
+
+def dfx_ping():
+    """Whether the replica answers `dfx ping`."""
+    try:
+        # Only the exit status matters, so neither stream needs a pipe
+        ping = subprocess.run(["dfx", "ping"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=TEST_DIR)
+        return ping.returncode == 0
+    except OSError:
+        return False
+
+
+def wait_for_dfx(timeout=30):
+    """Poll the replica until it answers or timeout."""
+    start = time.time()
+    while time.time() - start < timeout:
+        if dfx_ping():  # not the pidfile: the process exists before it accepts calls
+            return
+        time.sleep(0.2)
+    raise RuntimeError("dfx failed to start within timeout")
+
+
+def installed(name):
+    """Whether canister `name` exists on the local replica with code installed."""
+    return "Module hash: 0x" in run(["dfx", "canister", "info", name], check=False)
+
+
+def argument_file(init_arg):
+    """Write the Candid `init_arg` to a new private temp file for --argument-file (removed at exit), return its path."""
+    fd, path = tempfile.mkstemp(prefix="icw_init_", suffix=".did")  # unpredictable name, created 0600
+    with os.fdopen(fd, "w") as f:
+        f.write(init_arg)
+    atexit.register(os.remove, path)
+    return path
+
+
 def deploy_ledger():
-    """Deploy ckBTC ledger with initial balance to current principal."""
+    """Start deploying ckBTC ledger with initial balance to current principal; returns the dfx process."""
     principal = get_principal()
     print(f"Deploying ledger for principal: {principal}")
 
@@ -45,38 +117,44 @@ def deploy_ledger():
         "} })"
     )
 
-    run(["dfx", "deploy", "ckbtc_ledger", "--no-wallet", "--yes", f"--argument={init_arg}"])
-    return run(["dfx", "canister", "id", "ckbtc_ledger"])
+    return start(
+        ["dfx", "deploy", "ckbtc_ledger", "--no-wallet", "--yes", f"--argument-file={argument_file(init_arg)}"],
+        capture=False,  # only the exit status and stderr matter
+    )
 
 
 def deploy_indexer(ledger_id):
-    """Deploy ckBTC indexer."""
+    """Start deploying ckBTC indexer; returns the dfx process."""
     init_arg = (
         f"(opt variant {{ Init = record {{ "
         f'ledger_id = principal "{ledger_id}"; '
         f"retrieve_blocks_from_ledger_interval_seconds = opt 1 "
         f"}} }})"
     )
-    run(["dfx", "deploy", "ckbtc_indexer", "--no-wallet", f"--argument={init_arg}"])
-    return run(["dfx", "canister", "id", "ckbtc_indexer"])
+    return start(
+        ["dfx", "deploy", "ckbtc_indexer", "--no-wallet", f"--argument-file={argument_file(init_arg)}"], capture=False
+    )
 
 
 def icw(*args):
-    """Run icw CLI from tests directory (where dfx.json is)."""
-    result = subprocess.run(
-        [sys.executable, "-m", "icw.cli"] + list(args),
-        capture_output=True,
-        text=True,
-        cwd=TEST_DIR,  # must be where dfx.json is
-        env={**os.environ, "PYTHONPATH": os.path.join(TEST_DIR, "..", "src")},
-    )
-    return result
+    """Run the icw CLI in-process from tests directory (where dfx.json is), returning what a subprocess would."""
+    os.chdir(TEST_DIR)  # canister detection and dfx both look in the working directory
+    out, err = io.StringIO(), io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            code = cli.main(list(args))
+        except SystemExit as e:
+            code = e.code
+    if isinstance(code, str):  # sys.exit("message"): the interpreter would print it and exit 1
+        err.write(code + "\n")
+        code = 1
+    return types.SimpleNamespace(returncode=code or 0, stdout=out.getvalue(), stderr=err.getvalue())
 
 
 def test_balance():
     """Test icw balance command."""
     print("\n=== Test: icw balance ===")
-    local_ledger = run(["dfx", "canister", "id", "ckbtc_ledger"])
+    local_ledger = canister_id("ckbtc_ledger")
 
     result = icw("-n", "local", "balance", "-l", local_ledger)
     print(f"icw balance: {result.stdout}")
@@ -84,7 +162,7 @@ def test_balance():
         print(f"stderr: {result.stderr}")
     assert result.returncode == 0, f"icw balance failed: {result.stderr}"
 
-    data = json.loads(result.stdout)
+    data = json_loads(result.stdout)
     assert data["balance"] == 1000.0, f"Expected 1000.0, got {data['balance']}"
     assert data["raw"] == 100_000_000_000
     print(f"✓ Balance correct: {data['balance']} ckBTC")
@@ -93,7 +171,7 @@ def test_balance():
 def test_transfer():
     """Test icw transfer command."""
     print("\n=== Test: icw transfer ===")
-    local_ledger = run(["dfx", "canister", "id", "ckbtc_ledger"])
+    local_ledger = canister_id("ckbtc_ledger")
     principal = get_principal()
 
     result = icw("-n", "local", "transfer", principal, "0.01", "-s", "1", "-l", local_ledger, "--fee", "0")
@@ -102,7 +180,7 @@ def test_transfer():
         print(f"stderr: {result.stderr}")
     assert result.returncode == 0, f"icw transfer failed: {result.stderr}"
 
-    data = json.loads(result.stdout)
+    data = json_loads(result.stdout)
     assert data.get("ok") or "block" in str(data), f"Transfer failed: {data}"
     print("✓ Transfer successful")
 
@@ -110,7 +188,7 @@ def test_transfer():
 def test_transfer_with_balance_verification():
     """Test transfer by verifying sender and receiver balances."""
     print("\n=== Test: transfer with balance verification ===")
-    local_ledger = run(["dfx", "canister", "id", "ckbtc_ledger"])
+    local_ledger = canister_id("ckbtc_ledger")
     principal = get_principal()
 
     # First, fund subaccount 1 from minting account (default) so we have a non-minting sender
@@ -121,14 +199,14 @@ def test_transfer_with_balance_verification():
     # Get sender's initial balance (subaccount 1 - NOT the minting account)
     result = icw("-n", "local", "balance", "-s", "1", "-l", local_ledger)
     assert result.returncode == 0, f"Failed to get sender balance: {result.stderr}"
-    sender_before = json.loads(result.stdout)
+    sender_before = json_loads(result.stdout)
     sender_balance_before = sender_before["raw"]
     print(f"Sender (subaccount 1) balance before: {sender_before['balance']} ckBTC (raw: {sender_balance_before})")
 
     # Get receiver's initial balance (subaccount 2)
     result = icw("-n", "local", "balance", "-s", "2", "-l", local_ledger)
     assert result.returncode == 0, f"Failed to get receiver balance: {result.stderr}"
-    receiver_before = json.loads(result.stdout)
+    receiver_before = json_loads(result.stdout)
     receiver_balance_before = receiver_before["raw"]
     print(
         f"Receiver (subaccount 2) balance before: {receiver_before['balance']} ckBTC (raw: {receiver_balance_before})"
@@ -158,21 +236,21 @@ def test_transfer_with_balance_verification():
     print(f"Transfer result: {result.stdout}")
     assert result.returncode == 0, f"Transfer failed: {result.stderr}"
 
-    transfer_data = json.loads(result.stdout)
+    transfer_data = json_loads(result.stdout)
     assert transfer_data.get("ok"), f"Transfer not successful: {transfer_data}"
     print(f"✓ Transfer executed (block: {transfer_data.get('block')})")
 
     # Get sender's balance after transfer (subaccount 1)
     result = icw("-n", "local", "balance", "-s", "1", "-l", local_ledger)
     assert result.returncode == 0, f"Failed to get sender balance after: {result.stderr}"
-    sender_after = json.loads(result.stdout)
+    sender_after = json_loads(result.stdout)
     sender_balance_after = sender_after["raw"]
     print(f"Sender (subaccount 1) balance after: {sender_after['balance']} ckBTC (raw: {sender_balance_after})")
 
     # Get receiver's balance after transfer (subaccount 2)
     result = icw("-n", "local", "balance", "-s", "2", "-l", local_ledger)
     assert result.returncode == 0, f"Failed to get receiver balance after: {result.stderr}"
-    receiver_after = json.loads(result.stdout)
+    receiver_after = json_loads(result.stdout)
     receiver_balance_after = receiver_after["raw"]
     print(f"Receiver (subaccount 2) balance after: {receiver_after['balance']} ckBTC (raw: {receiver_balance_after})")
 
@@ -203,7 +281,7 @@ def test_icw_id():
     print(f"icw id: {result.stdout}")
     assert result.returncode == 0, f"icw id failed: {result.stderr}"
 
-    data = json.loads(result.stdout)
+    data = json_loads(result.stdout)
     assert "identity" in data
     assert "principal" in data
     print("✓ icw id works")
@@ -214,21 +292,41 @@ def main():
     print("ICW Integration Tests")
     print("=" * 60)
 
+    # ICW_REUSE_DFX=1 keeps the replica state between runs, so canisters deployed last time are used as-is.
+    # The tests only check the default account's fixed balance and before/after differences, so leftovers
+    # from earlier transfers don't matter.
+    reuse = os.getenv("ICW_REUSE_DFX") == "1"
+
     # Check dfx is running
-    try:
-        run(["dfx", "ping"], check=False)
-    except Exception:
+    if not replica_running():
         print("Starting dfx...")
-        subprocess.Popen(["dfx", "start", "--clean", "--background"], cwd=TEST_DIR)
-        time.sleep(5)
+        subprocess.Popen(["dfx", "start", "--background", *([] if reuse else ["--clean"])], cwd=TEST_DIR)
+        wait_for_dfx()
 
     # Deploy canisters
     print("\n=== Deploying Canisters ===")
-    ledger_id = deploy_ledger()
+    if reuse and installed("ckbtc_ledger") and installed("ckbtc_indexer"):
+        print("Reusing deployed canisters (ICW_REUSE_DFX=1)")
+        ledger_id = canister_id("ckbtc_ledger")
+    else:
+        # The indexer only needs the ledger's ID, which exists as soon as the canister is created,
+        # so both canisters can be installed at the same time
+        run(["dfx", "canister", "create", "--all", "--no-wallet"])
+        ledger_id = canister_id("ckbtc_ledger")
+        procs = []
+        try:
+            procs.append(deploy_ledger())
+            procs.append(deploy_indexer(ledger_id))
+            for proc in procs:
+                finish(proc)
+        finally:
+            # A failed deploy raises before the other one is waited on; don't leave that dfx running
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
     print(f"Ledger ID: {ledger_id}")
-
-    indexer_id = deploy_indexer(ledger_id)
-    print(f"Indexer ID: {indexer_id}")
+    print(f"Indexer ID: {canister_id('ckbtc_indexer')}")
 
     # Run tests
     test_icw_id()
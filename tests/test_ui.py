@@ -1,17 +1,20 @@
 #!/usr/bin/env python3
 """UI tests for ICW Web interface using Playwright."""
 
+import http.client
+import os
+import re
 import subprocess
 import time
 import sys
-import urllib.request
-import urllib.error
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.insert(0, "src")
 
 # Check if playwright is installed
 try:
-    from playwright.sync_api import sync_playwright
+    from playwright.sync_api import expect, sync_playwright
 except ImportError:
     print("Playwright not installed. Run: pip install playwright && playwright install chromium")
     sys.exit(1)
@@ -20,262 +23,290 @@ except ImportError:
 SERVER_PORT = 5556
 SERVER_URL = f"http://localhost:{SERVER_PORT}"
 
-# Timeout constants (in milliseconds)
-TIMEOUT_BALANCES_LOAD = 3000  # Wait for balances to load from API
-TIMEOUT_IDENTITY_LOAD = 2000  # Wait for identity to load
-TIMEOUT_ANIMATION = 500  # Wait for UI animations
-TIMEOUT_COLLAPSE = 300  # Wait for collapse animation
+
+# API calls the page makes on startup (index.html's init()); tests that only check static markup get them from
+# a per-worker copy instead of waiting on dfx and CoinGecko behind the server every time
+STARTUP_API = ["/api/config", "/api/identity", "/api/identities", "/api/prices", "/api/balances"]
+_startup_api = {}  # path -> (status, content type, body), fetched once per worker process
+
+
+def new_context(browser, cached_api=False):
+    """Open an isolated browser context; with `cached_api`, startup API calls are answered from the cache."""
+    context = browser.new_context()
+    if cached_api:
+        if not _startup_api:
+            for path in STARTUP_API:
+                r = context.request.get(SERVER_URL + path)
+                _startup_api[path] = (r.status, r.headers.get("content-type", "application/json"), r.body())
+
+        def serve(route):
+            hit = _startup_api.get(urllib.parse.urlsplit(route.request.url).path)
+            if hit:
+                route.fulfill(status=hit[0], content_type=hit[1], body=hit[2])
+            else:
+                route.continue_()
+
+        context.route("**/api/**", serve)
+    return context
+
+
+def api_response(path):
+    """Predicate for page.expect_response matching calls to the API endpoint `path`."""
+    return lambda response: response.url.split("?")[0].endswith(path)
 
 
 def wait_for_server(url, timeout=10):
     """Poll server until it responds or timeout."""
+    host = urllib.parse.urlsplit(url)
     start = time.time()
     while time.time() - start < timeout:
+        # A bare HEAD: any HTTP answer (even 405) means the server is accepting requests
+        conn = http.client.HTTPConnection(host.hostname, host.port, timeout=0.5)
         try:
-            urllib.request.urlopen(url, timeout=1)
+            conn.request("HEAD", "/")
+            conn.getresponse().read()
             return True
-        except (urllib.error.URLError, ConnectionRefusedError):
-            time.sleep(0.2)
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.05)
+        finally:
+            conn.close()
     return False
 
 
 def start_server():
-    """Start the ICW UI server in background."""
-    proc = subprocess.Popen(
+    """Start the ICW UI server in background (returns at once; see wait_for_server)."""
+    return subprocess.Popen(
         [sys.executable, "-c", f"from icw.api import run_server; run_server(port={SERVER_PORT}, open_browser=False)"],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
-    if not wait_for_server(SERVER_URL):
-        proc.terminate()
-        raise RuntimeError("Server failed to start within timeout")
-    return proc
 
 
-def test_page_loads():
+def test_page_loads(browser):
     """Page should load with title and header."""
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(SERVER_URL)
+    context = new_context(browser, cached_api=True)
+    page = context.new_page()
+    page.goto(SERVER_URL)
 
-        # Check title
-        assert "ICW" in page.title()
+    # Check title
+    assert "ICW" in page.title()
 
-        # Check header exists
-        header = page.locator("h1")
-        assert header.is_visible()
-        assert "ICW" in header.text_content()
+    # Check header exists
+    header = page.locator("h1")
+    assert header.is_visible()
+    assert "ICW" in header.text_content()
 
-        browser.close()
+    context.close()
     print("✓ test_page_loads")
 
 
-def test_balance_cards_visible():
+def test_balance_cards_visible(browser):
     """Balance cards for all tokens should be visible."""
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(SERVER_URL)
-        page.wait_for_load_state("networkidle")
+    context = new_context(browser)
+    page = context.new_page()
 
-        # Wait for balances to load
-        page.wait_for_timeout(TIMEOUT_BALANCES_LOAD)
+    # Wait for balances to load (the page fetches them once on startup)
+    with page.expect_response(api_response("/api/balances")) as balances:
+        page.goto(SERVER_URL)
+    assert balances.value.ok
 
-        # Check that token cards exist
-        cards = page.locator("text=ckBTC")
-        assert cards.count() >= 1
+    # Check that token cards exist
+    cards = page.locator("text=ckBTC")
+    assert cards.count() >= 1
 
-        browser.close()
+    context.close()
     print("✓ test_balance_cards_visible")
 
 
-def test_token_selector():
+def test_token_selector(browser):
     """Clicking token buttons should change selection."""
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(SERVER_URL)
-        page.wait_for_load_state("networkidle")
+    context = new_context(browser, cached_api=True)
+    page = context.new_page()
+    page.goto(SERVER_URL, wait_until="domcontentloaded")
 
-        # Find token selector buttons (in the form, not the submit button)
-        eth_button = page.get_by_role("button", name="CKETH", exact=True)
-        eth_button.click()
+    # Find token selector buttons (in the form, not the submit button)
+    eth_button = page.get_by_role("button", name="CKETH", exact=True)
+    eth_button.click()
 
-        # The button should now be selected (dark background)
-        assert "bg-gray-900" in eth_button.get_attribute("class")
+    # The button should now be selected (dark background) once Alpine re-renders
+    expect(eth_button).to_have_class(re.compile(r"\bbg-gray-900\b"))
 
-        browser.close()
+    context.close()
     print("✓ test_token_selector")
 
 
-def test_transfer_form_exists():
+def test_transfer_form_exists(browser):
     """Transfer form should have all required fields."""
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(SERVER_URL)
-        page.wait_for_load_state("networkidle")
+    context = new_context(browser, cached_api=True)
+    page = context.new_page()
+    page.goto(SERVER_URL, wait_until="domcontentloaded")
 
-        # Check form elements
-        assert page.locator("input[placeholder*='xxxxx']").is_visible()  # Recipient
-        assert page.locator("input[placeholder='0.00']").is_visible()  # Amount
-        assert page.locator("button[type='submit']").is_visible()  # Submit
+    # Check form elements
+    page.locator("form").wait_for(state="visible")
+    assert page.locator("input[placeholder*='xxxxx']").is_visible()  # Recipient
+    assert page.locator("input[placeholder='0.00']").is_visible()  # Amount
+    assert page.locator("button[type='submit']").is_visible()  # Submit
 
-        browser.close()
+    context.close()
     print("✓ test_transfer_form_exists")
 
 
-def test_identity_dropdown():
+def test_identity_dropdown(browser):
     """Identity dropdown should open and show identities."""
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(SERVER_URL)
-        page.wait_for_load_state("networkidle")
+    context = new_context(browser)
+    page = context.new_page()
 
-        # Wait for identity to load
-        page.wait_for_timeout(TIMEOUT_IDENTITY_LOAD)
+    # Wait for identities to load
+    with page.expect_response(api_response("/api/identities")):
+        page.goto(SERVER_URL)
 
-        # Click identity button (has green dot indicator)
-        identity_btn = page.locator("button").filter(has=page.locator(".bg-green-500")).first
-        if identity_btn.is_visible():
-            identity_btn.click()
-            page.wait_for_timeout(TIMEOUT_ANIMATION)
+    # Click identity button (has green dot indicator)
+    identity_btn = page.locator("button").filter(has=page.locator(".bg-green-500")).first
+    if identity_btn.is_visible():
+        identity_btn.click()
 
-        browser.close()
+    context.close()
     print("✓ test_identity_dropdown")
 
 
-def test_advanced_options_toggle():
+def test_advanced_options_toggle(browser):
     """Advanced options should expand when clicked."""
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(SERVER_URL)
-        page.wait_for_load_state("networkidle")
+    context = new_context(browser, cached_api=True)
+    page = context.new_page()
+    page.goto(SERVER_URL, wait_until="domcontentloaded")
 
-        # Click advanced options
-        page.locator("text=Advanced options").click()
-        page.wait_for_timeout(TIMEOUT_COLLAPSE)
+    # Click advanced options
+    page.locator("text=Advanced options").click()
 
-        # Subaccount fields should be visible (in the form, not modal)
-        assert page.locator("form label:has-text('To Subaccount')").is_visible()
-        assert page.locator("form label:has-text('From Subaccount')").is_visible()
-        assert page.locator("form label:has-text('Memo')").is_visible()
+    # Subaccount fields should be visible (in the form, not modal) once the collapse opens
+    page.locator("form label:has-text('To Subaccount')").wait_for(state="visible")
+    assert page.locator("form label:has-text('To Subaccount')").is_visible()
+    assert page.locator("form label:has-text('From Subaccount')").is_visible()
+    assert page.locator("form label:has-text('Memo')").is_visible()
 
-        browser.close()
+    context.close()
     print("✓ test_advanced_options_toggle")
 
 
-def test_network_selector():
+def test_network_selector(browser):
     """Network selector should have mainnet and local options."""
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(SERVER_URL)
-        page.wait_for_load_state("networkidle")
+    context = new_context(browser, cached_api=True)
+    page = context.new_page()
+    page.goto(SERVER_URL, wait_until="domcontentloaded")
 
-        # Check network selector
-        network_select = page.locator("select")
-        assert network_select.is_visible()
+    # Check network selector
+    network_select = page.locator("select")
+    network_select.wait_for(state="visible")
 
-        # Check options
-        options = network_select.locator("option").all_text_contents()
-        assert "Mainnet" in options
-        assert "Local" in options
+    # Check options
+    options = network_select.locator("option").all_text_contents()
+    assert "Mainnet" in options
+    assert "Local" in options
 
-        browser.close()
+    context.close()
     print("✓ test_network_selector")
 
 
-def test_principal_displayed():
+def test_principal_displayed(browser):
     """Principal should be displayed on the page."""
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(SERVER_URL)
-        page.wait_for_load_state("networkidle")
+    context = new_context(browser)
+    page = context.new_page()
 
-        # Wait for principal to load
-        page.wait_for_timeout(TIMEOUT_IDENTITY_LOAD)
+    # Wait for principal to load
+    with page.expect_response(api_response("/api/identity")):
+        page.goto(SERVER_URL)
 
-        # Principal should be in a monospace font element
-        principal_elem = page.locator(".font-mono")
-        assert principal_elem.count() >= 1
+    # Principal should be in a monospace font element
+    principal_elem = page.locator(".font-mono")
+    assert principal_elem.count() >= 1
 
-        browser.close()
+    context.close()
     print("✓ test_principal_displayed")
 
 
-def test_total_balance_displayed():
+def test_total_balance_displayed(browser):
     """Total balance card should be visible."""
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(SERVER_URL)
-        page.wait_for_load_state("networkidle")
+    context = new_context(browser, cached_api=True)
+    page = context.new_page()
+    page.goto(SERVER_URL, wait_until="domcontentloaded")
 
-        # Check total balance card exists
-        total_balance = page.locator("text=Total Balance")
-        assert total_balance.is_visible()
+    # Check total balance card exists
+    page.locator("text=Total Balance").wait_for(state="visible")
 
-        # Check USD value is displayed
-        usd_value = page.locator("text=$")
-        assert usd_value.count() >= 1
+    # Check USD value is displayed (rendered by Alpine)
+    page.locator("text=$").first.wait_for(state="visible")
 
-        browser.close()
+    context.close()
     print("✓ test_total_balance_displayed")
 
 
-def test_logo_displayed():
+def test_logo_displayed(browser):
     """Logo should be visible in header."""
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(SERVER_URL)
-        page.wait_for_load_state("networkidle")
+    context = new_context(browser, cached_api=True)
+    page = context.new_page()
+    page.goto(SERVER_URL, wait_until="domcontentloaded")
 
-        # Check logo image exists
-        logo = page.locator("img[alt='ICW']")
-        assert logo.is_visible()
+    # Check logo image exists
+    page.locator("img[alt='ICW']").wait_for(state="visible")
 
-        browser.close()
+    context.close()
     print("✓ test_logo_displayed")
 
 
-def test_price_timestamp():
+def test_price_timestamp(browser):
     """Price update timestamp should be shown."""
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.goto(SERVER_URL)
-        page.wait_for_load_state("networkidle")
+    context = new_context(browser)
+    page = context.new_page()
 
-        # Wait for prices to load
-        page.wait_for_timeout(TIMEOUT_BALANCES_LOAD)
+    # Wait for prices to load
+    with page.expect_response(api_response("/api/prices")):
+        page.goto(SERVER_URL)
 
-        # Check for price timestamp text (may say "just now" or "Xs ago")
-        # May not always be visible if prices haven't loaded
-        page.locator("text=/Prices updated/")
-        browser.close()
+    # Check for price timestamp text (may say "just now" or "Xs ago"); it appears as soon as
+    # /api/prices answers, even if CoinGecko had no prices to give
+    page.locator("text=/^Prices /").wait_for(state="visible")
+    context.close()
     print("✓ test_price_timestamp")
 
 
+TESTS = [
+    test_page_loads,
+    test_balance_cards_visible,
+    test_token_selector,
+    test_transfer_form_exists,
+    test_identity_dropdown,
+    test_advanced_options_toggle,
+    test_network_selector,
+    test_principal_displayed,
+    test_total_balance_displayed,
+    test_logo_displayed,
+    test_price_timestamp,
+]
+
+
+def run_tests(tests):
+    """Run `tests` in order on one Chromium, launched once instead of per test."""
+    with sync_playwright() as p:
+        # Chromium and the Playwright driver start up while the server is still booting
+        browser = p.chromium.launch(headless=True)
+        try:
+            if not wait_for_server(SERVER_URL):
+                raise RuntimeError("Server failed to start within timeout")
+            for test in tests:
+                test(browser)
+        finally:
+            browser.close()
+
+
 if __name__ == "__main__":
     server = start_server()
     try:
-        test_page_loads()
-        test_balance_cards_visible()
-        test_token_selector()
-        test_transfer_form_exists()
-        test_identity_dropdown()
-        test_advanced_options_toggle()
-        test_network_selector()
-        test_principal_displayed()
-        test_total_balance_displayed()
-        test_logo_displayed()
-        test_price_timestamp()
+        # Tests only read from the shared server, so they run side by side; each worker
+        # process drives its own browser through its share of the tests
+        workers = min(len(TESTS), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(run_tests, TESTS[i::workers]) for i in range(workers)]:
+                future.result()  # re-raises a failed test's AssertionError here
         print("\nAll UI tests passed!")
     finally:
         server.terminate()